@@ -0,0 +1,189 @@
+# Copyright 2017 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the blocks in shinysdr.filters.
+
+Run as ``python -m shinysdr.benchmark_filters``. Results are written as JSON; a previous run's output may be given with --compare to check for performance regressions.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import json
+import sys
+from timeit import default_timer
+
+import six
+
+from gnuradio import blocks
+from gnuradio import gr
+
+from shinysdr.filters import MultistageChannelFilter, _design_resampler, _make_filter_plan_1, make_resampler
+
+
+# Common device and audio rates.
+_FILTER_INPUT_RATES = [2400000, 2048000, 1000000, 250000]
+_FILTER_OUTPUT_RATES = [48000, 44100]
+_RESAMPLER_RATES = [(48000, 44100), (44100, 48000), (250000, 48000)]
+
+# Filter shape used for MultistageChannelFilter cases, typical of narrowband demodulators.
+_CUTOFF_FREQ = 5000
+_TRANSITION_WIDTH = 1000
+
+
+def run_benchmarks(sample_count=10000000, design_repeat=3):
+    """Run all benchmarks and return the results as a JSON-compatible dict."""
+    results = []
+    for input_rate in _FILTER_INPUT_RATES:
+        for output_rate in _FILTER_OUTPUT_RATES:
+            results.append(_benchmark_channel_filter(input_rate, output_rate, sample_count, design_repeat))
+    for input_rate, output_rate in _RESAMPLER_RATES:
+        results.append(_benchmark_resampler(input_rate, output_rate, sample_count, design_repeat))
+    return {
+        'sample_count': sample_count,
+        'results': results,
+    }
+
+
+def _benchmark_channel_filter(input_rate, output_rate, sample_count, design_repeat):
+    def design():
+        # Bypasses the plan cache, which would make all but the first repetition free.
+        return _make_filter_plan_1(input_rate, output_rate)._with_taps(_CUTOFF_FREQ, _TRANSITION_WIDTH)
+    
+    plan = design()
+    return {
+        'kind': 'MultistageChannelFilter',
+        'input_rate': input_rate,
+        'output_rate': output_rate,
+        'design_seconds': _time_best(design, design_repeat),
+        'taps': sum(len(taps) for _design, taps in plan.get_stage_designs_and_taps() if taps is not None),
+        'stages': len(plan.get_stage_designs()),
+        'samples_per_second': _measure_throughput(
+            MultistageChannelFilter(
+                input_rate=input_rate,
+                output_rate=output_rate,
+                cutoff_freq=_CUTOFF_FREQ,
+                transition_width=_TRANSITION_WIDTH),
+            sample_count),
+    }
+
+
+def _benchmark_resampler(input_rate, output_rate, sample_count, design_repeat):
+    def design():
+        return make_resampler(input_rate, output_rate, complex=True)
+    
+    resampler = design()
+    _rational, taps = _design_resampler(input_rate, output_rate)
+    return {
+        'kind': 'make_resampler',
+        'input_rate': input_rate,
+        'output_rate': output_rate,
+        'design_seconds': _time_best(design, design_repeat),
+        'taps': len(taps),
+        'stages': 1,
+        'samples_per_second': _measure_throughput(resampler, sample_count),
+    }
+
+
+def _time_best(f, repeat):
+    best = None
+    for _ in six.moves.range(repeat):
+        start = default_timer()
+        f()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _measure_throughput(block, sample_count):
+    """Return the number of input samples per second block processes."""
+    top = gr.top_block()
+    top.connect(
+        blocks.null_source(gr.sizeof_gr_complex),
+        blocks.head(gr.sizeof_gr_complex, sample_count),
+        block,
+        blocks.null_sink(gr.sizeof_gr_complex))
+    start = default_timer()
+    top.run()
+    elapsed = default_timer() - start
+    return sample_count / elapsed
+
+
+def compare_results(baseline, current, threshold):
+    """Return a list of messages describing cases in current which are more than threshold (a fraction) slower than in baseline."""
+    baseline_by_case = {_case_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = baseline_by_case.get(_case_key(result))
+        if old is None:
+            continue
+        old_rate = old['samples_per_second']
+        new_rate = result['samples_per_second']
+        if new_rate < old_rate * (1 - threshold):
+            regressions.append('%s %s -> %s: throughput decreased by %.0f%%' % (
+                result['kind'], result['input_rate'], result['output_rate'],
+                100 * (1 - new_rate / old_rate)))
+        old_time = old['design_seconds']
+        new_time = result['design_seconds']
+        if new_time * (1 - threshold) > old_time:
+            regressions.append('%s %s -> %s: design time increased from %.4f s to %.4f s' % (
+                result['kind'], result['input_rate'], result['output_rate'],
+                old_time, new_time))
+    return regressions
+
+
+def _case_key(result):
+    return (result['kind'], result['input_rate'], result['output_rate'])
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('--samples', dest='sample_count', type=int, default=10000000,
+        help='number of samples to process in each throughput test')
+    parser.add_argument('--compare', metavar='FILE',
+        help='previous results to compare against; exit with status 1 if there is a regression')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='fractional slowdown which is considered a regression (default 0.1)')
+    return parser.parse_args(args=argv[1:])
+
+
+def benchmark_main(argv=None, out=None):
+    """Entry point for the benchmark command.
+    
+    Optional arguments are for testing.
+    """
+    options = _parse_args(argv if argv is not None else sys.argv)
+    out = out or sys.stdout
+    
+    results = run_benchmarks(sample_count=options.sample_count)
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write('\n')
+    
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, options.threshold)
+        for message in regressions:
+            print(message, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark_main()
@@ -21,11 +21,18 @@ GNU Radio blocks which automatically compute appropriate filter designs.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from collections import OrderedDict
 from fractions import gcd
-from math import pi, sin, cos
+import hashlib
+from math import ceil, log, pi
+import os
+import os.path
+import tempfile
 
+import numpy
 import six
 
+from gnuradio import blocks
 from gnuradio import gr
 from gnuradio.fft import window
 from gnuradio import filter as grfilter  # don't shadow builtin
@@ -36,6 +43,7 @@ from gnuradio.filter import rational_resampler
 from shinysdr.interfaces import BandShape
 from shinysdr.i.math import factorize, small_factor_at_least
 from shinysdr.i.pycompat import defaultstr
+from shinysdr.values import ExportedState, after_state_batch, exported_value
 
 
 __all__ = []  # appended later
@@ -44,15 +52,202 @@ __all__ = []  # appended later
 _use_rational_resampler = True
 
 
+class _LRUCache(object):
+    """A mapping of limited size which discards the least recently used entries, and counts its hits and misses."""
+    
+    def __init__(self, max_size):
+        self.__max_size = max_size
+        self.__entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.__entries)
+    
+    def get(self, key):
+        """Return the value for key, or None if there is none."""
+        entries = self.__entries
+        if key in entries:
+            self.hits += 1
+            value = entries.pop(key)
+            entries[key] = value  # move to most recently used
+            return value
+        else:
+            self.misses += 1
+            return None
+    
+    def put(self, key, value):
+        entries = self.__entries
+        entries.pop(key, None)
+        entries[key] = value
+        while len(entries) > self.__max_size:
+            entries.popitem(last=False)
+    
+    def clear(self):
+        self.__entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class _TapFileCache(object):
+    """Stores designed filter taps as .npy files in a directory, so that they can be reused across flowgraph rebuilds and process restarts.
+    
+    Files are named by a hash of the design parameters. When the total size of the files exceeds max_bytes, the least recently used are deleted.
+    """
+    
+    def __init__(self, directory, max_bytes):
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+    
+    def get_directory(self):
+        return self.__directory
+    
+    def get_or_design(self, params, design):
+        """Return the taps for params (a tuple of strings and numbers), calling design() to compute them if they are not cached.
+        
+        The returned taps are a read-only numpy array.
+        """
+        path = os.path.join(self.__directory, self.__key(params) + '.npy')
+        try:
+            taps = numpy.load(path, mmap_mode='r', allow_pickle=False)
+        except (IOError, OSError, ValueError):
+            pass
+        else:
+            self.hits += 1
+            try:
+                os.utime(path, None)  # mark as recently used
+            except OSError:
+                pass
+            return taps
+        
+        self.misses += 1
+        taps = numpy.array(design())
+        taps.flags.writeable = False
+        try:
+            self.__store(path, taps)
+        except (IOError, OSError):
+            # The cache is only an optimization; carry on without it.
+            pass
+        return taps
+    
+    def __key(self, params):
+        # repr() of floats is exact and the same on Python 2 and 3, but repr() of strings is not, so format them ourselves.
+        text = '\n'.join(
+            p if isinstance(p, six.string_types) else repr(float(p))
+            for p in (_TAP_FILE_CACHE_VERSION,) + tuple(params))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+    
+    def __store(self, path, taps):
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+        # Write under a temporary name and rename, so that concurrent readers never see a partial file.
+        fd, temp_path = tempfile.mkstemp(dir=self.__directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, taps, allow_pickle=False)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        self.__evict()
+    
+    def __evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.__directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.__directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.__max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+# Change this if the meaning of cached taps changes, to avoid using stale files.
+_TAP_FILE_CACHE_VERSION = 'shinysdr-taps-1'
+
+_tap_file_cache = None
+
+
+def set_tap_cache_directory(directory, max_bytes=64 * 1024 * 1024):
+    """Store designed filter taps in the given directory, to speed up creating filters later. If directory is None, stop doing so.
+    
+    The directory is created if it does not exist. At most about max_bytes of taps are kept.
+    """
+    global _tap_file_cache
+    if directory is None:
+        _tap_file_cache = None
+    else:
+        _tap_file_cache = _TapFileCache(directory, max_bytes)
+
+
+__all__.append('set_tap_cache_directory')
+
+
+def _cached_taps(params, design):
+    """Return taps from the tap file cache if it is enabled, and otherwise call design()."""
+    cache = _tap_file_cache
+    if cache is None:
+        return design()
+    else:
+        return cache.get_or_design(params, design)
+
+
+def _low_pass_taps(gain, sampling_freq, cutoff_freq, transition_width):
+    """Equivalent to firdes.low_pass (with default window), but cached."""
+    return _cached_taps(
+        ('firdes.low_pass', gain, sampling_freq, cutoff_freq, transition_width),
+        lambda: firdes.low_pass(gain, sampling_freq, cutoff_freq, transition_width))
+
+
+# Filter plans, with and without taps, shared among all filters with the same parameters. Keys are (input_rate, output_rate, cutoff_freq, transition_width); plans without taps have cutoff_freq and transition_width of -1.
+_filter_plan_cache = _LRUCache(max_size=64)
+
+
+def _get_filter_plan(input_rate, output_rate, cutoff_freq=-1, transition_width=-1):
+    """Return a _MultistageChannelFilterPlan for the given parameters, reusing a previous design if possible.
+    
+    If cutoff_freq and transition_width are not given, the plan will not have taps.
+    """
+    key = (input_rate, output_rate, float(cutoff_freq), float(transition_width))
+    plan = _filter_plan_cache.get(key)
+    if plan is None:
+        if cutoff_freq == -1 and transition_width == -1:
+            plan = _make_filter_plan_1(input_rate=input_rate, output_rate=output_rate)
+        else:
+            plan = _get_filter_plan(input_rate, output_rate)._with_taps(
+                cutoff_freq=cutoff_freq,
+                transition_width=transition_width)
+        _filter_plan_cache.put(key, plan)
+    return plan
+
+
 class _MultistageChannelFilterPlan(object):
     """
     Description of a MultistageChannelFilter without any instantiation. The analogue of
     an array of taps for a single-stage filter.
+    
+    Plans are immutable and may be shared (see _get_filter_plan).
     """
     
-    def __init__(self, stage_designs, freq_xlate_stage, cutoff_freq, transition_width, taps=None):
+    def __init__(self, stage_designs, freq_xlate_stage, cutoff_freq, transition_width, taps=None, design_rates=None):
         self.__stage_designs = stage_designs
         self.__taps = taps if taps is not None else [None for _ in stage_designs]
+        self.__design_rates = design_rates  # (input_rate, output_rate) as given to _make_filter_plan_1
         self.__freq_xlate_stage = freq_xlate_stage
         self.__cutoff_freq = float(cutoff_freq)
         self.__transition_width = float(transition_width)
@@ -68,6 +263,10 @@ class _MultistageChannelFilterPlan(object):
     
     def get_freq_xlate_stage(self):
         return self.__freq_xlate_stage
+    
+    def get_block_keys(self):
+        """Return a value which is equal for two plans if and only if the blocks created for one can be reused for the other by changing only their taps."""
+        return [design.block_key(taps) for design, taps in self.get_stage_designs_and_taps()]
 
     def get_cutoff_freq(self):
         return self.__cutoff_freq
@@ -85,22 +284,76 @@ class _MultistageChannelFilterPlan(object):
             transition_width = self.__transition_width
         assert cutoff_freq > 0
         assert transition_width > 0
+        if self.__design_rates is not None:
+            input_rate, output_rate = self.__design_rates
+            return _get_filter_plan(input_rate, output_rate, cutoff_freq, transition_width)
+        else:
+            return self._with_taps(cutoff_freq, transition_width)
+    
+    def _with_taps(self, cutoff_freq, transition_width):
+        """Compute taps for a new plan, without consulting the cache."""
+        assert cutoff_freq > 0
+        assert transition_width > 0
         return _MultistageChannelFilterPlan(
             stage_designs=self.__stage_designs,
             taps=[
-                design.calculate_taps(
+                _immutable_taps(design.calculate_taps(
                     final_cutoff=cutoff_freq,
-                    final_transition=transition_width)
+                    final_transition=transition_width))
                 for design in self.__stage_designs],
             freq_xlate_stage=self.__freq_xlate_stage,
             cutoff_freq=cutoff_freq,
-            transition_width=transition_width)
+            transition_width=transition_width,
+            design_rates=self.__design_rates)
+
+
+def _immutable_taps(taps):
+    return tuple(taps) if taps is not None else None
+
+
+def _estimate_ntaps(sampling_freq, transition_width, attenuation_db=53):
+    """Estimate the length of a firdes.low_pass filter, as firdes.compute_ntaps does. The default attenuation is that of the default Hamming window."""
+    ntaps = int(attenuation_db * sampling_freq / (22.0 * transition_width))
+    return ntaps | 1
+
+
+def _fir_filter_cost(ntaps, decimation):
+    """Estimated cost, in multiply-accumulate operations per output sample, of a fir_filter_ccc."""
+    # pylint: disable=unused-argument
+    # A decimating FIR filter computes only the outputs it keeps.
+    return ntaps
+
+
+def _fft_filter_cost(ntaps, decimation):
+    """Estimated cost, in multiply-accumulate operations per output sample, of a fft_filter_ccc."""
+    # Block size chosen by fft_filter_ccc.
+    fft_size = 2 * 2 ** int(ceil(log(ntaps, 2)))
+    samples_per_block = fft_size - ntaps + 1
+    # A forward and inverse FFT plus the product; the filter computes every output and then discards those not wanted by the decimation.
+    block_cost = fft_size * log(fft_size, 2) + fft_size
+    return block_cost / samples_per_block * decimation
+
+
+def _use_fft_filter(ntaps, decimation):
+    return _fft_filter_cost(ntaps, decimation) < _fir_filter_cost(ntaps, decimation)
 
 
 class _FilterPlanStage(object):
     def __init__(self, input_rate, output_rate):
         self.input_rate = input_rate
         self.output_rate = output_rate
+    
+    def estimate_cost(self, taps):
+        """Return the estimated multiply-accumulate operations per second this stage will perform with the given taps, or None if not known."""
+        raise NotImplementedError()
+    
+    def block_key(self, taps):
+        """Return a value describing the block create_block would create, excluding taps and the input rate of a frequency translating block."""
+        raise NotImplementedError()
+    
+    def get_filter_rate(self):
+        """Return the sample rate at which the taps are applied."""
+        return self.input_rate
 
 
 class _FilterPlanCommentStage(_FilterPlanStage):
@@ -116,6 +369,12 @@ class _FilterPlanCommentStage(_FilterPlanStage):
     def calculate_taps(self, final_cutoff, final_transition):
         return None
     
+    def estimate_cost(self, taps):
+        return 0
+    
+    def block_key(self, taps):
+        return (type(self),)
+    
     def explain(self):
         return self.comment
 
@@ -137,6 +396,12 @@ class _FilterPlanXlateStage(_FilterPlanStage):
     def calculate_taps(self, final_cutoff, final_transition):
         return [1]
     
+    def estimate_cost(self, taps):
+        return self.output_rate * _fir_filter_cost(len(taps), 1)
+    
+    def block_key(self, taps):
+        return (type(self),)
+    
     def explain(self):
         return 'freq xlation only'
 
@@ -157,11 +422,24 @@ class _FilterPlanDecimatingStage(_FilterPlanStage):
                 0,
                 self.input_rate)
         else:
-            if len(taps) > 10:
+            if _use_fft_filter(len(taps), self.decimation):
                 return grfilter.fft_filter_ccc(self.decimation, taps, 1)
             else:
                 return grfilter.fir_filter_ccc(self.decimation, taps)
     
+    def estimate_cost(self, taps):
+        return self.output_rate * self.estimate_cost_per_output(len(taps))
+    
+    def block_key(self, taps):
+        fft = not self.freq_xlating and _use_fft_filter(len(taps), self.decimation)
+        return (type(self), self.freq_xlating, self.decimation, fft)
+    
+    def estimate_cost_per_output(self, ntaps):
+        if self.freq_xlating:
+            return _fir_filter_cost(ntaps, self.decimation)
+        else:
+            return min(_fir_filter_cost(ntaps, self.decimation), _fft_filter_cost(ntaps, self.decimation))
+    
     def calculate_taps(self, final_cutoff, final_transition):
         # TODO check for collision with user filter
         user_inner = final_cutoff - final_transition / 2
@@ -210,15 +488,51 @@ class _FilterPlanRationalResamplerStage(_FilterPlanStage):
     
     def calculate_taps(self, final_cutoff, final_transition):
         # TODO: This might be internal, and we eventually want to integrate it in the plan anyway
-        return rational_resampler.design_filter(
-            interpolation=self.interpolation,
-            decimation=self.decimation,
-            fractional_bw=0.4)
+        return _cached_taps(
+            ('rational_resampler.design_filter', self.interpolation, self.decimation, 0.4),
+            lambda: rational_resampler.design_filter(
+                interpolation=self.interpolation,
+                decimation=self.decimation,
+                fractional_bw=0.4))
+    
+    def estimate_ntaps(self):
+        """Estimate the length of the filter calculate_taps designs, without designing it."""
+        # rational_resampler.design_filter uses a Kaiser window with beta 7, whose attenuation firdes takes to be beta / 0.1102 + 8.7 dB.
+        transition_width = min(1, self.interpolation / self.decimation) * (0.5 - 0.4)
+        return _estimate_ntaps(self.interpolation, transition_width, attenuation_db=7 / 0.1102 + 8.7)
+    
+    def estimate_cost(self, taps):
+        return self.estimate_cost_for_ntaps(len(taps))
+    
+    def block_key(self, taps):
+        return (type(self), self.interpolation, self.decimation)
+    
+    def get_filter_rate(self):
+        return self.input_rate * self.interpolation
+    
+    def estimate_cost_for_ntaps(self, ntaps):
+        # Polyphase implementation: each output uses one of the interpolation subfilters. Real taps cost half as much as complex taps.
+        return self.output_rate * ntaps / self.interpolation / 2
     
     def explain(self):
         return 'rational_resampler by %s/%s (stage rates %s/%s)' % (self.interpolation, self.decimation, self.output_rate, self.input_rate)
 
 
+class _FilterPlanFinalRationalResamplerStage(_FilterPlanRationalResamplerStage):
+    """Combination of _FilterPlanFinalDecimatingStage and _FilterPlanRationalResamplerStage, where the resampler's filter is the final filter."""
+    
+    def calculate_taps(self, final_cutoff, final_transition):
+        return firdes.low_pass(
+            self.interpolation,  # gain compensates for interpolation
+            self.input_rate * self.interpolation,  # filter runs at the interpolated rate
+            final_cutoff,
+            final_transition,
+            firdes.WIN_HAMMING)
+    
+    def explain(self):
+        return 'final filter and ' + super(_FilterPlanFinalRationalResamplerStage, self).explain()
+
+
 class _FilterPlanPfbResamplerStage(_FilterPlanStage):
     def __init__(self, resample_rate, **kwargs):
         self.resample_rate = resample_rate
@@ -226,18 +540,63 @@ class _FilterPlanPfbResamplerStage(_FilterPlanStage):
             **kwargs)
     
     def create_block(self, taps):
-        return pfb.arb_resampler_ccf(self.resample_rate)  # TODO explicitly compute taps
+        return pfb.arb_resampler_ccf(self.resample_rate, taps=taps)
     
     def calculate_taps(self, final_cutoff, final_transition):
-        return None
+        if _tap_file_cache is None:
+            # Let arb_resampler_ccf design its own taps.
+            return None
+        else:
+            # The default design uses optfir, which is slow, so cache it.
+            return _cached_taps(
+                ('pfb.arb_resampler_ccf', self.resample_rate),
+                lambda: _design_arb_resampler_taps(self.resample_rate))
+    
+    def block_key(self, taps):
+        return (type(self), self.resample_rate, taps is None)
+    
+    def get_filter_rate(self):
+        return self.input_rate * 32  # arb_resampler_ccf's default filter bank size
+    
+    def estimate_cost(self, taps):
+        if taps is None:
+            return None
+        # Each output is interpolated between two of the 32 subfilters.
+        return self.output_rate * 2 * len(taps) / 32
     
     def explain(self):
         return 'arb_resampler %s/%s = %s' % (self.output_rate, self.input_rate, float(self.output_rate) / self.input_rate)
 
 
+def _design_arb_resampler_taps(rate, flt_size=32, atten=100):
+    """Return the taps pfb.arb_resampler_ccf designs for itself when not given any, without constructing the block."""
+    # This follows the design in gnuradio.filter.pfb.arb_resampler_ccf.
+    percent = 0.80
+    if rate < 1:
+        # filter to less than half the output bandwidth to avoid aliasing
+        halfband = 0.5 * rate
+        bw = percent * halfband
+        tb = (percent / 2.0) * halfband
+        return firdes.low_pass_2(flt_size, flt_size, bw, tb, atten, firdes.WIN_BLACKMAN_HARRIS)
+    else:
+        # filter to less than half the channel width to prevent images
+        halfband = 0.5
+        bw = percent * halfband
+        tb = (percent / 2.0) * halfband
+        ripple = 0.1
+        while True:
+            try:
+                return grfilter.optfir.low_pass(flt_size, flt_size, bw, bw + tb, ripple, atten)
+            except RuntimeError:
+                ripple += 0.01
+                if ripple >= 1.0:
+                    raise RuntimeError('optfir could not generate an appropriate filter.')
+
+
 def _make_filter_plan_1(input_rate, output_rate):
     assert input_rate > 0
     assert output_rate > 0
+    design_rates = (input_rate, output_rate)
     
     total_decimation = max(1, int(input_rate // output_rate))
     
@@ -249,10 +608,8 @@ def _make_filter_plan_1(input_rate, output_rate):
         if input_rate > output_rate:
             total_decimation = input_rate // small_factor_at_least(input_rate, output_rate)
         # print(input_rate / total_decimation, total_decimation, input_rate, output_rate, input_rate // gcd(input_rate, output_rate))
-        # TODO: Don't re-factorize unnecessarily
     
-    stage_decimations = factorize(total_decimation)
-    stage_decimations.reverse()
+    stage_decimations = _choose_stage_decimations(input_rate, output_rate, total_decimation)
     
     # loop variables
     stage_designs = []
@@ -293,7 +650,6 @@ def _make_filter_plan_1(input_rate, output_rate):
             comment='No final resampler stage.',
             rate=output_rate))
     else:
-        # TODO: systematically combine resampler with final filter stage
         if using_rational_resampler:
             if stage_input_rate % 1 != 0:
                 raise Exception("shouldn't happen", stage_input_rate)
@@ -301,13 +657,17 @@ def _make_filter_plan_1(input_rate, output_rate):
             common = gcd(output_rate, stage_input_rate)
             interpolation = output_rate // common
             decimation = stage_input_rate // common
-            stage_designs.append(_FilterPlanRationalResamplerStage(
+            resampler_stage = _FilterPlanRationalResamplerStage(
                 interpolation=interpolation,
                 decimation=decimation,
                 input_rate=stage_input_rate,
-                output_rate=output_rate))
+                output_rate=output_rate)
+            fused_stage = _fuse_final_stage(stage_designs[-1], resampler_stage)
+            if fused_stage is not None:
+                stage_designs[-1] = fused_stage
+            else:
+                stage_designs.append(resampler_stage)
         else:
-            # TODO: cache filter computation as optfir is used and takes a noticeable time
             stage_designs.append(_FilterPlanPfbResamplerStage(
                 resample_rate=float(output_rate) / stage_input_rate,
                 input_rate=stage_input_rate,
@@ -317,12 +677,95 @@ def _make_filter_plan_1(input_rate, output_rate):
         stage_designs=stage_designs,
         freq_xlate_stage=freq_xlate_stage,
         cutoff_freq=-1,
-        transition_width=-1)
+        transition_width=-1,
+        design_rates=design_rates)
     
     return plan
 
 
-class MultistageChannelFilter(gr.hier_block2):
+def _choose_stage_decimations(input_rate, output_rate, total_decimation):
+    """Return the list of per-stage decimations, whose product is total_decimation, with the least estimated cost.
+    
+    The structure of a plan must not depend on the cutoff frequency, so that it can be changed without rebuilding the filter; therefore, the cost is estimated for a nominal filter shape relative to output_rate.
+    """
+    nominal_cutoff, nominal_transition = _nominal_shape(output_rate)
+    user_inner = nominal_cutoff - nominal_transition / 2
+    
+    divisors = _divisors(total_decimation)
+    best = {}  # decimation done so far -> (cost of remaining stages, remaining stage decimations)
+    
+    # Dynamic programming: the cost of the remaining stages depends only on the decimation done before them, so fill in the table starting from the end.
+    for done in reversed(divisors):
+        remaining = total_decimation // done
+        if remaining == 1:
+            best[done] = (0, [])
+            continue
+        stage_input_rate = input_rate / done
+        candidates = []
+        for decimation in divisors:
+            if decimation == 1 or remaining % decimation != 0:
+                continue
+            stage_output_rate = stage_input_rate / decimation
+            if decimation == remaining:
+                # final stage, as designed by _FilterPlanFinalDecimatingStage
+                transition = nominal_transition
+            else:
+                # as designed by _FilterPlanDecimatingStage
+                transition = stage_output_rate / 2 - user_inner
+                if transition <= 0:
+                    continue
+            stage = _FilterPlanDecimatingStage(
+                freq_xlating=done == 1,
+                decimation=decimation,
+                input_rate=stage_input_rate,
+                output_rate=stage_output_rate)
+            stage_cost = stage_output_rate * stage.estimate_cost_per_output(_estimate_ntaps(stage_input_rate, transition))
+            rest_cost, rest_decimations = best[done * decimation]
+            candidates.append((stage_cost + rest_cost, [decimation] + rest_decimations))
+        best[done] = min(candidates)
+    
+    return best[1][1]
+
+
+def _fuse_final_stage(final_stage, resampler_stage):
+    """Return a _FilterPlanFinalRationalResamplerStage doing the work of both given stages, or None if that is not possible or not estimated to be cheaper."""
+    if not isinstance(final_stage, _FilterPlanFinalDecimatingStage) or final_stage.freq_xlating:
+        # The frequency translation has to happen somewhere.
+        return None
+    input_rate = int(final_stage.input_rate)
+    output_rate = resampler_stage.output_rate
+    common = gcd(output_rate, input_rate)
+    fused_stage = _FilterPlanFinalRationalResamplerStage(
+        interpolation=output_rate // common,
+        decimation=input_rate // common,
+        input_rate=input_rate,
+        output_rate=output_rate)
+    
+    _nominal_cutoff, nominal_transition = _nominal_shape(output_rate)
+    separate_cost = (
+        final_stage.output_rate * final_stage.estimate_cost_per_output(_estimate_ntaps(final_stage.input_rate, nominal_transition)) +
+        resampler_stage.estimate_cost_for_ntaps(resampler_stage.estimate_ntaps()))
+    fused_cost = fused_stage.estimate_cost_for_ntaps(
+        _estimate_ntaps(input_rate * fused_stage.interpolation, nominal_transition))
+    return fused_stage if fused_cost < separate_cost else None
+
+
+def _nominal_shape(output_rate):
+    """Return the cutoff frequency and transition width for which plans are optimized, given the output rate."""
+    return 0.4 * output_rate, 0.05 * output_rate
+
+
+def _divisors(n):
+    """Return the positive divisors of n in increasing order."""
+    divisors = [1]
+    prime_factors = factorize(n)
+    for prime in sorted(set(prime_factors)):
+        power_divisors = [prime ** k for k in six.moves.range(1, prime_factors.count(prime) + 1)]
+        divisors = divisors + [d * p for d in divisors for p in power_divisors]
+    return sorted(divisors)
+
+
+class MultistageChannelFilter(ExportedState, gr.hier_block2):
     """
     Provides frequency translation, low-pass filtering, and arbitrary sample rate conversion.
     
@@ -343,10 +786,9 @@ class MultistageChannelFilter(gr.hier_block2):
             # early check for better errors since our cascaded filters might be cryptically nonsense
             raise ValueError('cutoff_freq (%s) is too high for output_rate (%s)' % (cutoff_freq, output_rate))
     
-        plan = _make_filter_plan_1(
+        plan = _get_filter_plan(
             input_rate=input_rate,
-            output_rate=output_rate)
-        plan = plan.replace(
+            output_rate=output_rate,
             cutoff_freq=cutoff_freq,
             transition_width=transition_width)
         self.__plan = plan
@@ -373,7 +815,9 @@ class MultistageChannelFilter(gr.hier_block2):
         
         self.freq_filter_block = self.stages[plan.get_freq_xlate_stage()]
         assert self.freq_filter_block is not None
-        self.freq_filter_block.set_center_freq(center_freq)
+        # The sample rate freq_filter_block was created with, which it cannot change. If the input rate is changed by set_rates, its center frequency is scaled to compensate.
+        self.__freq_filter_block_rate = plan.get_stage_designs()[plan.get_freq_xlate_stage()].input_rate
+        self.set_center_freq(center_freq)
     
     def __do_taps(self):
         """Re-assign taps for all stages."""
@@ -383,6 +827,7 @@ class MultistageChannelFilter(gr.hier_block2):
         for stage_filter, (_stage_design, taps) in zip(self.stages, self.__plan.get_stage_designs_and_taps()):
             if hasattr(stage_filter, 'set_taps'):
                 stage_filter.set_taps(taps)
+        self.state_changed('description')
     
     def explain(self):
         """Return a description of the filter design."""
@@ -409,15 +854,61 @@ class MultistageChannelFilter(gr.hier_block2):
             else:
                 s += '\n  %s' % (
                     stage_design.explain(),)
+        costs = [stage_design.estimate_cost(taps) for stage_design, taps in self.__plan.get_stage_designs_and_taps()]
+        if None in costs:
+            s += '\n  Estimated cost unknown.'
+        else:
+            s += '\n  Estimated cost %.1f MACs per output sample.' % (sum(costs) / stage_designs[-1].output_rate,)
         return s
     
+    def describe(self):
+        """Return a description of the filter design as JSON-compatible data.
+        
+        The result is a dict with the overall input_rate, output_rate, mac_per_second (estimated multiply-accumulate operations per second, or None if unknown) and group_delay (in seconds), and a list of stages, each of which is a dict with:
+        
+        description: human-readable, as in explain().
+        input_rate, output_rate: sample rates.
+        taps: number of taps, or None if the stage has no taps of its own.
+        block: type name of the GNU Radio block, or None if the stage has no block.
+        mac_per_second: as above, for this stage.
+        group_delay: in seconds, assuming symmetric taps.
+        """
+        stage_descriptions = []
+        for stage_filter, (stage_design, taps) in zip(self.stages, self.__plan.get_stage_designs_and_taps()):
+            stage_descriptions.append({
+                'description': stage_design.explain(),
+                'input_rate': stage_design.input_rate,
+                'output_rate': stage_design.output_rate,
+                'taps': len(taps) if taps is not None else None,
+                'block': type(stage_filter).__name__ if stage_filter is not None else None,
+                'mac_per_second': stage_design.estimate_cost(taps),
+                'group_delay': (len(taps) - 1) / 2 / stage_design.get_filter_rate() if taps is not None else 0,
+            })
+        stage_costs = [d['mac_per_second'] for d in stage_descriptions]
+        return {
+            'input_rate': stage_descriptions[0]['input_rate'],
+            'output_rate': stage_descriptions[-1]['output_rate'],
+            'mac_per_second': None if None in stage_costs else sum(stage_costs),
+            'group_delay': sum(d['group_delay'] for d in stage_descriptions),
+            'stages': stage_descriptions,
+        }
+    
+    @exported_value(type=dict, changes='explicit', label='Filter design', version_getter='_get_plan')
+    def get_description(self):
+        return self.describe()
+    
+    def _get_plan(self):
+        # The plan is replaced, never mutated, whenever the design changes, so it serves as the description's version.
+        return self.__plan
+    
     def get_cutoff_freq(self):
         return self.__plan.get_cutoff_freq()
     
     def set_cutoff_freq(self, value):
         value = float(value)
         self.__plan = self.__plan.replace(cutoff_freq=value)
-        self.__do_taps()
+        # a demodulator changing both the cutoff and the transition width, as when its state is restored, needs only one redesign
+        after_state_batch(self.__do_taps)
     
     def get_transition_width(self):
         return self.__plan.get_transition_width()
@@ -425,13 +916,47 @@ class MultistageChannelFilter(gr.hier_block2):
     def set_transition_width(self, value):
         value = float(value)
         self.__plan = self.__plan.replace(transition_width=value)
-        self.__do_taps()
+        after_state_batch(self.__do_taps)
     
     def get_center_freq(self):
-        return self.freq_filter_block.center_freq()
+        return self.freq_filter_block.center_freq() / self.__freq_filter_rate_scale()
     
     def set_center_freq(self, freq):
-        self.freq_filter_block.set_center_freq(freq)
+        self.freq_filter_block.set_center_freq(freq * self.__freq_filter_rate_scale())
+    
+    def __freq_filter_rate_scale(self):
+        plan = self.__plan
+        actual_rate = plan.get_stage_designs()[plan.get_freq_xlate_stage()].input_rate
+        if actual_rate == self.__freq_filter_block_rate:
+            return 1
+        else:
+            return self.__freq_filter_block_rate / actual_rate
+    
+    def set_rates(self, input_rate, output_rate):
+        """Change the input and output sample rates without rebuilding the filter, if possible.
+        
+        This is possible if the new rates call for the same stages, differing only in their taps. Returns True if the rates were changed, or False if a new MultistageChannelFilter must be created instead, in which case this filter is unchanged.
+        
+        The cutoff frequency, transition width, and center frequency are kept.
+        """
+        if self.get_cutoff_freq() > output_rate / 2:
+            raise ValueError('cutoff_freq (%s) is too high for output_rate (%s)' % (self.get_cutoff_freq(), output_rate))
+        old_plan = self.__plan
+        new_plan = _get_filter_plan(
+            input_rate=input_rate,
+            output_rate=output_rate,
+            cutoff_freq=old_plan.get_cutoff_freq(),
+            transition_width=old_plan.get_transition_width())
+        if new_plan is old_plan:
+            return True
+        if (new_plan.get_freq_xlate_stage() != old_plan.get_freq_xlate_stage() or
+                new_plan.get_block_keys() != old_plan.get_block_keys()):
+            return False
+        center_freq = self.get_center_freq()
+        self.__plan = new_plan
+        self.__do_taps()
+        self.set_center_freq(center_freq)
+        return True
     
     def get_shape(self):
         """Describe the filter shape as a shinysdr.interfaces.BandShape value.
@@ -444,12 +969,117 @@ class MultistageChannelFilter(gr.hier_block2):
 __all__.append('MultistageChannelFilter')
 
 
+class SharedChannelizer(gr.hier_block2):
+    """
+    Splits a wideband signal into channel_count equally spaced, overlapping sub-channels using a polyphase filterbank.
+    
+    When many receivers are tuned within one wideband signal, this takes the place of the first, most expensive, stage of each of their MultistageChannelFilters: the cost of the filterbank does not depend on the number of receivers. Each receiver instead uses the output nearest its frequency (see find_channel and make_channel_filter), which is at a much lower rate, and filters it further.
+    
+    Output i is centered at frequency i * input_rate / channel_count relative to the input (with the upper half of the outputs being negative frequencies), and has a sample rate of get_channel_rate().
+    """
+    
+    # Fraction of the channel spacing, on each side of a sub-channel's center, in which the sub-channel's response is flat.
+    _usable_fraction = 0.6
+    
+    def __init__(self,
+            name='SharedChannelizer',
+            input_rate=0,
+            channel_count=2,
+            oversample_rate=2):
+        if channel_count < 2:
+            raise ValueError('channel_count (%s) must be at least 2' % (channel_count,))
+        if channel_count % oversample_rate != 0:
+            raise ValueError('channel_count (%s) must be a multiple of oversample_rate (%s)' % (channel_count, oversample_rate))
+        
+        self.__input_rate = input_rate
+        self.__channel_count = channel_count
+        self.__oversample_rate = oversample_rate
+        
+        gr.hier_block2.__init__(
+            self, defaultstr(name),
+            gr.io_signature(1, 1, gr.sizeof_gr_complex * 1),
+            gr.io_signature(channel_count, channel_count, gr.sizeof_gr_complex * 1),
+        )
+        
+        # Designed with a sample rate of channel_count, so the channel spacing is 1 and the taps do not depend on input_rate. The passband extends beyond half the spacing so that adjacent sub-channels overlap; oversampling keeps the transition band from aliasing.
+        taps = _cached_taps(
+            ('SharedChannelizer', channel_count),
+            lambda: firdes.low_pass(
+                1.0,
+                channel_count,
+                self._usable_fraction + 0.2,
+                0.4,
+                firdes.WIN_HAMMING))
+        channelizer = pfb.channelizer_ccf(channel_count, taps, oversample_rate)
+        self.connect(self, channelizer)
+        for i in six.moves.range(channel_count):
+            self.connect((channelizer, i), (self, i))
+            # Not every output will be in use, and they must all be consumed for the channelizer to run.
+            self.connect((channelizer, i), blocks.null_sink(gr.sizeof_gr_complex))
+    
+    def get_input_rate(self):
+        return self.__input_rate
+    
+    def get_channel_count(self):
+        return self.__channel_count
+    
+    def get_channel_spacing(self):
+        return self.__input_rate / self.__channel_count
+    
+    def get_channel_rate(self):
+        """Return the sample rate of each output."""
+        return self.get_channel_spacing() * self.__oversample_rate
+    
+    def find_channel(self, center_freq, cutoff_freq, transition_width):
+        """Return the output, and the frequency within that output, which can be used to receive the given band.
+        
+        center_freq is relative to the input. cutoff_freq and transition_width are as for MultistageChannelFilter.
+        
+        Returns a tuple of (output index, center frequency within the output), or None if the band does not fit within any single output.
+        """
+        spacing = self.get_channel_spacing()
+        k = int(round(center_freq / spacing))
+        residual_freq = center_freq - k * spacing
+        if abs(residual_freq) + cutoff_freq + transition_width / 2 > self._usable_fraction * spacing:
+            return None
+        return k % self.__channel_count, residual_freq
+    
+    def make_channel_filter(self,
+            name='MultistageChannelFilter',
+            output_rate=0,
+            cutoff_freq=0,
+            transition_width=0,
+            center_freq=0):
+        """Create a MultistageChannelFilter to follow this channelizer, as an alternative to one taking the full-rate input.
+        
+        Returns a tuple of (output index, filter) where the filter should be connected to the output of this block with that index, or None if the band does not fit within any single output (in which case the full-rate input should be used instead).
+        
+        If the center frequency is later changed, use find_channel to check whether the filter can be reused.
+        """
+        found = self.find_channel(center_freq, cutoff_freq, transition_width)
+        if found is None:
+            return None
+        index, residual_freq = found
+        return index, MultistageChannelFilter(
+            name=name,
+            input_rate=self.get_channel_rate(),
+            output_rate=output_rate,
+            cutoff_freq=cutoff_freq,
+            transition_width=transition_width,
+            center_freq=residual_freq)
+
+
+__all__.append('SharedChannelizer')
+
+
 # TODO: Rename for consistency. Document.
-# TODO: Add the ability to memoize/precompute filter taps, particularly because pfb uses optfir internally which is slow. Maybe we can express this using the same 'plan' type as MultistageChannelFilter.
+# TODO: Maybe we can express this using the same 'plan' type as MultistageChannelFilter.
 # TODO: I think there are places where we are _not_ using make_resampler because it didn't have a complex mode before.
-def make_resampler(in_rate, out_rate, complex=False):
-    # pylint: disable=redefined-builtin
-    
+_RESAMPLER_PFB_SIZE = 32  # TODO: justify magic number (taken from gqrx)
+
+
+def _design_resampler(in_rate, out_rate):
+    """Return (rational, taps) for make_resampler, where rational is (interpolation, decimation) for a rational_resampler, or None for an arb_resampler."""
     fractional_cutoff = 0.4
     fractional_transition_width = 0.2
     
@@ -466,25 +1096,33 @@ def make_resampler(in_rate, out_rate, complex=False):
         common = gcd(in_rate, out_rate)
         interpolation = out_rate // common
         decimation = in_rate // common
+        return (interpolation, decimation), _low_pass_taps(
+            interpolation,  # gain compensates for interpolation
+            interpolation,  # rational resampler filter runs at the interpolated rate
+            in_relative_cutoff,
+            in_relative_transition_width)
+    else:
+        return None, _low_pass_taps(
+            _RESAMPLER_PFB_SIZE,
+            _RESAMPLER_PFB_SIZE,
+            in_relative_cutoff,
+            in_relative_transition_width)
+
+
+def make_resampler(in_rate, out_rate, complex=False):
+    # pylint: disable=redefined-builtin
+    rational, taps = _design_resampler(in_rate, out_rate)
+    if rational is not None:
+        interpolation, decimation = rational
         return (rational_resampler.rational_resampler_ccf if complex else rational_resampler.rational_resampler_fff)(
             interpolation=interpolation,
             decimation=decimation,
-            taps=firdes.low_pass(
-                interpolation,  # gain compensates for interpolation
-                interpolation,  # rational resampler filter runs at the interpolated rate
-                in_relative_cutoff,
-                in_relative_transition_width))
+            taps=taps)
     else:
-        resample_ratio = out_rate / in_rate
-        pfbsize = 32  # TODO: justify magic number (taken from gqrx)
         return (pfb.arb_resampler_ccf if complex else pfb.arb_resampler_fff)(
-            resample_ratio,
-            firdes.low_pass(
-                pfbsize,
-                pfbsize,
-                in_relative_cutoff,
-                in_relative_transition_width),
-            pfbsize)
+            out_rate / in_rate,
+            taps,
+            _RESAMPLER_PFB_SIZE)
 
 
 __all__.append('make_resampler')
@@ -498,28 +1136,37 @@ def design_sawtooth_filter(
     """
     This filter has a response which increases or decreases linearly with frequency, cut at f_s/2. Its gain is 1 at frequency 0 and thus also 1 averaged over all frequencies.
     """
-    window_values = window.build(window_type, ntaps, beta)
+    key = (ntaps, decreasing, window_type, beta)
+    taps = _sawtooth_filter_cache.get(key)
+    if taps is None:
+        taps = _design_sawtooth_filter(ntaps, decreasing, window_type, beta)
+        taps.flags.writeable = False
+        _sawtooth_filter_cache.put(key, taps)
+    # a fresh list each time, so callers cannot alter the cached design
+    return taps.tolist()
+
+
+_sawtooth_filter_cache = _LRUCache(max_size=32)
+
+
+def _design_sawtooth_filter(ntaps, decreasing, window_type, beta):
+    window_values = numpy.array(window.build(window_type, ntaps, beta))
     
     # Formula provided by Olli Niemitalo in <http://dsp.stackexchange.com/a/28035/4655>.
-    taps = []
-    for i in six.moves.range(0, ntaps):
-        k = i - ntaps // 2  # k = 0 at middle
-        if k == 0:
-            # substitute limit for division by zero
-            ideal_response = complex(pi, 0)
-        else:
-            # The real part is pi * sinc(k), but that is always zero when k != 0.
-            ideal_response = complex(0, sin(pi * k) / (pi * k * k) - cos(pi * k) / k)
-        taps.append(window_values[i] * ideal_response)
-        
+    k = numpy.arange(ntaps) - ntaps // 2  # k = 0 at middle
+    nonzero_k = numpy.where(k == 0, 1, k)  # avoid dividing by zero; those elements are replaced below
+    # The real part is pi * sinc(k), but that is always zero when k != 0.
+    ideal_response = 1j * (numpy.sin(pi * k) / (pi * nonzero_k * nonzero_k) - numpy.cos(pi * k) / nonzero_k)
+    # substitute limit for division by zero
+    ideal_response[k == 0] = pi
+    taps = window_values * ideal_response
+    
     # Compute gain at frequency 0, and divide by it so as to set the wanted gain.
-    gain_factor = 1.0 / abs(sum(taps))
-    for i in six.moves.range(0, ntaps):
-        taps[i] *= gain_factor
+    taps /= abs(numpy.sum(taps))
     
     # Reverse if appropriate.
     if decreasing:
-        taps = taps[::-1]
+        taps = taps[::-1].copy()
     return taps
 
 
@@ -0,0 +1,189 @@
+# Copyright 2018 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Persistence of ExportedState as a snapshot file plus an append-only journal of changes.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import os.path
+
+from twisted.internet import defer
+from twisted.internet import reactor as the_reactor
+from twisted.logger import Logger
+
+from shinysdr.snapshot import StateSnapshotter, _parse_pointer
+
+
+__all__ = []  # appended later
+
+
+_log = Logger()
+
+
+class StateJournal(object):
+    """Keeps the persistent state of root_object in filename.
+    
+    The file itself holds a snapshot in the same format as state_to_json(), and each change is appended to a journal, filename + '.journal', as a JSON Patch operation per line. The journal is flushed to disk write_delay seconds after the first change following a write, so a crash loses at most that much. Once it holds more than compact_threshold operations (or on close()), the journal is folded into a new snapshot.
+    
+    On construction, the snapshot (or get_defaults(root_object) if there is none) and journal are read and applied to root_object with state_from_json.
+    
+    context is the SubscriptionContext used to watch root_object's cells.
+    """
+    def __init__(self,
+            root_object,
+            filename,
+            context,
+            get_defaults=lambda _: {},
+            reactor=the_reactor,
+            write_delay=1.0,
+            compact_threshold=1000):
+        self.__filename = filename
+        self.__journal_filename = filename + '.journal'
+        self.__reactor = reactor
+        self.__write_delay = write_delay
+        self.__compact_threshold = compact_threshold
+        self.__write_call = None
+        self.__journal_file = None
+        self.__journal_length = 0
+        
+        state = _read_snapshot(filename)
+        if state is None:
+            state = get_defaults(root_object)
+        state = _replay_journal(state, self.__journal_filename)
+        root_object.state_from_json(state)
+        
+        self.__snapshotter = StateSnapshotter(
+            root_object,
+            context,
+            history_length=2,
+            on_change=self.__changed)
+        self.__written_version = None
+        self.__compact()
+    
+    def __changed(self):
+        if self.__write_call is None:
+            self.__write_call = self.__reactor.callLater(self.__write_delay, self.__write)
+    
+    def __write(self):
+        self.__write_call = None
+        version, _ = self.__snapshotter.snapshot()
+        if version == self.__written_version:
+            return
+        operations = self.__snapshotter.delta(self.__written_version, version)
+        if operations is None or self.__journal_length + len(operations) > self.__compact_threshold:
+            self.__compact()
+        else:
+            self.__append(operations, version)
+    
+    def __append(self, operations, version):
+        f = self.__journal_file
+        for operation in operations:
+            f.write(json.dumps(operation, separators=(',', ':'), sort_keys=True).encode('ascii') + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+        self.__journal_length += len(operations)
+        self.__written_version = version
+    
+    def __compact(self):
+        """Write a complete snapshot and start a new, empty journal."""
+        version, state = self.__snapshotter.snapshot()
+        if self.__journal_file is not None and version != self.__written_version:
+            # Bring the journal up to date first, so that if we crash before it is truncated, replaying it onto the new snapshot gives the same state.
+            operations = self.__snapshotter.delta(self.__written_version, version)
+            if operations is None:
+                operations = [{'op': 'replace', 'path': '', 'value': state}]
+            self.__append(operations, version)
+        # At startup no journal is open yet; the one just replayed is already reflected in state.
+        _write_file_atomically(self.__filename, json.dumps(state, indent=4, sort_keys=True).encode('ascii'))
+        if self.__journal_file is not None:
+            self.__journal_file.close()
+        self.__journal_file = open(self.__journal_filename, 'wb')
+        self.__journal_length = 0
+        self.__written_version = version
+    
+    def sync(self):
+        """Write any pending changes to the journal now. Returns a Deferred which fires when done, as PersistenceFileGlue.sync does."""
+        if self.__write_call is not None:
+            self.__write_call.cancel()
+            self.__write()
+        return defer.succeed(None)
+    
+    def close(self):
+        """Write all pending changes and stop watching root_object."""
+        if self.__write_call is not None:
+            self.__write_call.cancel()
+            self.__write_call = None
+        self.__compact()
+        self.__journal_file.close()
+        self.__journal_file = None
+        self.__snapshotter.close()
+
+
+__all__.append('StateJournal')
+
+
+def _read_snapshot(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def _replay_journal(state, journal_filename):
+    """Return state with the operations in the journal file applied."""
+    if not os.path.exists(journal_filename):
+        return state
+    with open(journal_filename, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            try:
+                operation = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # Most likely the final line was incompletely written.
+                _log.warn('Ignoring unreadable journal {filename} from line {line_number}', filename=journal_filename, line_number=line_number)
+                break
+            state = _apply_operation(state, operation)
+    return state
+
+
+def _apply_operation(state, operation):
+    """Apply a JSON Patch operation produced by json_patch, ignoring operations on nonexistent locations (as may result from replaying a journal onto a snapshot which already includes it)."""
+    keys = _parse_pointer(operation['path'])
+    if not keys:
+        return operation['value'] if operation['op'] != 'remove' else {}
+    container = state
+    for key in keys[:-1]:
+        container = container.get(key) if isinstance(container, dict) else None
+    if not isinstance(container, dict):
+        return state
+    if operation['op'] == 'remove':
+        container.pop(keys[-1], None)
+    else:
+        container[keys[-1]] = operation['value']
+    return state
+
+
+def _write_file_atomically(filename, data):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_filename, filename)
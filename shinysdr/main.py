@@ -24,6 +24,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import argparse
 import logging
+import os.path
 import sys
 
 from twisted.application.service import IService, MultiService
@@ -77,6 +78,8 @@ def _main_async(reactor, argv=None, _abort_for_test=False):
         help='open the UI in a web browser')
     argParser.add_argument('--force-run', dest='force_run', action='store_true',
         help='Run DSP even if no client is connected (for debugging).')
+    argParser.add_argument('--journal', dest='journal', action='store_true',
+        help='save state changes to an append-only journal instead of rewriting the whole state file')
     args = argParser.parse_args(args=argv[1:])
 
     # Verify we can actually run.
@@ -102,22 +105,46 @@ def _main_async(reactor, argv=None, _abort_for_test=False):
         defer.returnValue(None)
         return
     
+    if os.path.isdir(args.config_path):
+        # imported here because it loads gnuradio
+        from shinysdr.filters import set_tap_cache_directory
+        set_tap_cache_directory(os.path.join(args.config_path, 'tap-cache'))
+    
     _log.info('Constructing...')
     app = config_obj._create_app()
     
+    # imported here because it loads gnuradio
+    from shinysdr.values import BatchPoller, SubscriptionContext
+    # Continuously changing cells are polled together per object; other subscriptions go to the usual poller.
+    subscription_context = SubscriptionContext(
+        reactor=reactor,
+        poller=BatchPoller(reactor=reactor, fallback=the_subscription_context.poller))
+    
     reactor.addSystemEventTrigger('during', 'shutdown', app.close_all_devices)
     
     _log.info('Restoring state...')
-    pfg = PersistenceFileGlue(
-        reactor=reactor,
-        root_object=app,
-        filename=config_obj._state_filename,
-        get_defaults=_app_defaults)
+    if args.journal:
+        # imported here because it loads gnuradio
+        from shinysdr.journal import StateJournal
+        pfg = StateJournal(
+            reactor=reactor,
+            root_object=app,
+            filename=config_obj._state_filename,
+            get_defaults=_app_defaults,
+            context=subscription_context)
+        reactor.addSystemEventTrigger('during', 'shutdown', pfg.close)
+    else:
+        pfg = PersistenceFileGlue(
+            reactor=reactor,
+            root_object=app,
+            filename=config_obj._state_filename,
+            get_defaults=_app_defaults)
     
     _log.info('Starting web server...')
     services = MultiService()
     for maker in config_obj._service_makers:
-        IService(maker(app)).setServiceParent(services)
+        # Services subscribe to cells on behalf of their clients, so they are given the batching context rather than using the global one.
+        IService(maker(app, subscription_context=subscription_context)).setServiceParent(services)
     services.startService()
     
     _log.info('ShinySDR is ready.')
@@ -129,7 +156,7 @@ def _main_async(reactor, argv=None, _abort_for_test=False):
     if args.force_run:
         _log.debug('force_run')
         # TODO kludge, make this less digging into guts
-        app.get_receive_flowgraph().get_monitor().state()['fft'].subscribe2(lambda v: None, the_subscription_context)
+        app.get_receive_flowgraph().get_monitor().state()['fft'].subscribe2(lambda v: None, subscription_context)
     
     if _abort_for_test:
         services.stopService()
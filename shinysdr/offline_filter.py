@@ -0,0 +1,209 @@
+# Copyright 2017 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Executes MultistageChannelFilter designs using NumPy, without a GNU Radio flowgraph, for processing recordings.
+
+The results are equivalent to, but not sample-for-sample identical with, those of MultistageChannelFilter.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import namedtuple
+import multiprocessing
+
+import numpy
+import six
+
+from shinysdr.filters import (
+    _FilterPlanCommentStage,
+    _FilterPlanDecimatingStage,
+    _FilterPlanRationalResamplerStage,
+    _FilterPlanXlateStage,
+    _get_filter_plan,
+)
+
+
+__all__ = []  # appended later
+
+
+class OfflineChannelFilter(object):
+    """
+    Frequency translation, low-pass filtering, and sample rate conversion of complex samples supplied in arbitrary-sized chunks; the NumPy counterpart of shinysdr.filters.MultistageChannelFilter.
+    
+    Only designs using rational resampling (integer rates) are supported.
+    """
+    def __init__(self, input_rate, output_rate, cutoff_freq, transition_width, center_freq=0):
+        if cutoff_freq > output_rate / 2:
+            raise ValueError('cutoff_freq (%s) is too high for output_rate (%s)' % (cutoff_freq, output_rate))
+        plan = _get_filter_plan(
+            input_rate=input_rate,
+            output_rate=output_rate,
+            cutoff_freq=float(cutoff_freq),
+            transition_width=float(transition_width))
+        self.__processors = []
+        for i, (stage_design, taps) in enumerate(plan.get_stage_designs_and_taps()):
+            if i == plan.get_freq_xlate_stage():
+                self.__processors.append(_Mixer(center_freq / stage_design.input_rate))
+            if isinstance(stage_design, (_FilterPlanCommentStage, _FilterPlanXlateStage)):
+                pass
+            elif isinstance(stage_design, _FilterPlanDecimatingStage):
+                self.__processors.append(_PolyphaseFilter(taps, 1, stage_design.decimation))
+            elif isinstance(stage_design, _FilterPlanRationalResamplerStage):
+                self.__processors.append(_PolyphaseFilter(taps, stage_design.interpolation, stage_design.decimation))
+            else:
+                raise ValueError('%s cannot be performed offline' % (stage_design.explain(),))
+    
+    def process(self, samples):
+        """Filter the next chunk of input samples and return the output samples (which may be empty) as a numpy array of complex64."""
+        samples = numpy.asarray(samples, dtype=numpy.complex128)
+        for processor in self.__processors:
+            samples = processor.process(samples)
+        return samples.astype(numpy.complex64)
+
+
+__all__.append('OfflineChannelFilter')
+
+
+class _Mixer(object):
+    """Shifts the given frequency (in cycles per sample) to zero, keeping the phase continuous between chunks."""
+    def __init__(self, frequency):
+        self.__frequency = frequency
+        self.__phase = 0.0  # in cycles
+    
+    def process(self, samples):
+        if self.__frequency == 0:
+            return samples
+        count = len(samples)
+        phases = self.__phase + self.__frequency * numpy.arange(count)
+        self.__phase = (self.__phase + self.__frequency * count) % 1.0
+        return samples * numpy.exp(-2j * numpy.pi * phases)
+
+
+class _PolyphaseFilter(object):
+    """FIR filter with rational resampling (interpolate, filter, decimate), keeping the filter state between chunks."""
+    
+    # Approximate number of (output, tap) products computed at once, to bound memory use.
+    _block_elements = 2 ** 20
+    
+    def __init__(self, taps, interpolation, decimation):
+        taps = numpy.asarray(taps, dtype=numpy.complex128)
+        self.__interpolation = interpolation
+        self.__decimation = decimation
+        # Row p holds the taps applied to the input when the output falls at phase p of the interpolated signal; column q is the tap for the input q samples before the newest one.
+        subfilter_length = -(-len(taps) // interpolation)
+        padded = numpy.zeros(subfilter_length * interpolation, dtype=numpy.complex128)
+        padded[:len(taps)] = taps
+        self.__subfilters = padded.reshape(subfilter_length, interpolation).T.copy()
+        self.__subfilter_length = subfilter_length
+        # Input samples not yet discarded, starting at absolute index self.__held_start. The initial state is zeros, as in GNU Radio.
+        self.__held = numpy.zeros(subfilter_length - 1, dtype=numpy.complex128)
+        self.__held_start = -(subfilter_length - 1)
+        self.__next_output = 0
+    
+    def process(self, samples):
+        interpolation = self.__interpolation
+        decimation = self.__decimation
+        held = numpy.concatenate([self.__held, samples])
+        input_end = self.__held_start + len(held)  # absolute index after the last input sample
+        # Output n uses input samples up to index (n * decimation) // interpolation.
+        output_end = -(-input_end * interpolation // decimation)
+        outputs = []
+        q = numpy.arange(self.__subfilter_length)
+        block_size = max(1, self._block_elements // self.__subfilter_length)
+        for block_start in six.moves.range(self.__next_output, output_end, block_size):
+            n = numpy.arange(block_start, min(block_start + block_size, output_end))
+            position = n * decimation
+            newest = position // interpolation
+            indexes = (newest - self.__held_start)[:, numpy.newaxis] - q[numpy.newaxis, :]
+            outputs.append(numpy.sum(held[indexes] * self.__subfilters[position % interpolation], axis=1))
+        
+        # Keep only what the next output will need.
+        next_newest = output_end * decimation // interpolation
+        keep_from = min(len(held), next_newest - (self.__subfilter_length - 1) - self.__held_start)
+        self.__held = held[keep_from:]
+        self.__held_start += keep_from
+        self.__next_output = output_end
+        
+        if outputs:
+            return numpy.concatenate(outputs)
+        else:
+            return numpy.zeros(0, dtype=numpy.complex128)
+
+
+OfflineChannel = namedtuple('OfflineChannel', [
+    'center_freq',  # relative to the recording's center frequency
+    'output_rate',
+    'cutoff_freq',
+    'transition_width',
+])
+
+
+__all__.append('OfflineChannel')
+
+
+def filter_recording(filename, input_rate, channels, dtype=numpy.complex64, chunk_size=2 ** 20, processes=None):
+    """Extract channels from a recording of complex samples.
+    
+    filename: a file of raw samples of the given dtype (such as written by GNU Radio's file_sink), or a .npy file.
+    channels: a list of OfflineChannel.
+    processes: if greater than 1, distribute the channels among that many worker processes.
+    
+    Returns a list of numpy arrays of complex64, one for each channel.
+    """
+    if processes is not None and processes > 1 and len(channels) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(_filter_recording_worker, [
+                (filename, input_rate, [channel], dtype, chunk_size)
+                for channel in channels])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return _filter_recording(filename, input_rate, channels, dtype, chunk_size)
+
+
+__all__.append('filter_recording')
+
+
+def _filter_recording_worker(args):
+    return _filter_recording(*args)[0]
+
+
+def _filter_recording(filename, input_rate, channels, dtype, chunk_size):
+    # The whole recording is mapped but only one chunk at a time is touched, so this works for recordings larger than memory.
+    if filename.endswith('.npy'):
+        recording = numpy.load(filename, mmap_mode='r')
+    else:
+        recording = numpy.memmap(filename, dtype=dtype, mode='r')
+    filters = [
+        OfflineChannelFilter(
+            input_rate=input_rate,
+            output_rate=channel.output_rate,
+            cutoff_freq=channel.cutoff_freq,
+            transition_width=channel.transition_width,
+            center_freq=channel.center_freq)
+        for channel in channels]
+    outputs = [[] for _ in channels]
+    for start in six.moves.range(0, len(recording), chunk_size):
+        chunk = numpy.asarray(recording[start:start + chunk_size])
+        for f, output in zip(filters, outputs):
+            output.append(f.process(chunk))
+    return [
+        numpy.concatenate(output) if output else numpy.zeros(0, dtype=numpy.complex64)
+        for output in outputs]
@@ -0,0 +1,239 @@
+# Copyright 2018 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Incrementally maintained equivalents of ExportedState.state_to_json.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+
+import six
+
+
+__all__ = []  # appended later
+
+
+class StateSnapshotter(object):
+    """Produces snapshots of the persistent state of an ExportedState, equal to what its state_to_json() would return.
+    
+    The JSON of each object in the tree is cached and only recomputed once a subscription to one of its cells (or its shape) reports a change, so a snapshot costs time proportional to what has changed since the previous one. Note that changes are noticed only as the notifications are delivered via the context's reactor.
+    
+    Snapshots share unchanged subtrees with each other and must not be mutated.
+    
+    root_object: the ExportedState to serialize.
+    context: a SubscriptionContext used to subscribe to its cells.
+    history_length: the number of recent snapshots kept available for delta().
+    on_change: optional function called, with no arguments, when the state may have changed since the last snapshot.
+    """
+    def __init__(self, root_object, context, history_length=16, on_change=None):
+        self.__dirty = True
+        self.__version = 0
+        self.__history = OrderedDict()  # version -> snapshot
+        self.__history_length = history_length
+        self.__on_change = on_change
+        self.__root = _SnapshotNode(root_object, context, self.__root_dirty)
+    
+    def __root_dirty(self):
+        was_dirty = self.__dirty
+        self.__dirty = True
+        if not was_dirty and self.__on_change is not None:
+            self.__on_change()
+    
+    def snapshot(self):
+        """Return a tuple of (version, state), where the version number changes if and only if the state does."""
+        if self.__dirty or not self.__history:
+            self.__dirty = False
+            state = self.__root.get_json()
+            if self.__history and state is self.__history[self.__version]:
+                # marked dirty but nothing was actually different
+                return self.__version, state
+            self.__version += 1
+            self.__history[self.__version] = state
+            while len(self.__history) > self.__history_length:
+                self.__history.popitem(last=False)
+        return self.__version, self.__history[self.__version]
+    
+    def get_version(self):
+        """Return the version of the most recent snapshot."""
+        return self.__version
+    
+    def delta(self, from_version, to_version=None):
+        """Return a list of JSON Patch (RFC 6902) operations which change snapshot from_version into snapshot to_version (default: the most recent).
+        
+        Returns None if either snapshot is no longer available, in which case a full snapshot should be used instead.
+        """
+        if to_version is None:
+            to_version = self.__version
+        old = self.__history.get(from_version)
+        new = self.__history.get(to_version)
+        if old is None or new is None:
+            return None
+        return json_patch(old, new)
+    
+    def close(self):
+        """Unsubscribe from everything."""
+        self.__root.close()
+
+
+__all__.append('StateSnapshotter')
+
+
+class _SnapshotNode(object):
+    """The cached JSON of one ExportedState, and subscriptions to keep it up to date."""
+    def __init__(self, obj, context, on_dirty):
+        self.__object = obj
+        self.__context = context
+        self.__on_dirty = on_dirty
+        self.__cells = {}  # key -> persistent cell
+        self.__subscriptions = {}  # key -> ISubscription
+        self.__children = {}  # key -> _SnapshotNode, for reference cells
+        self.__json = {}
+        self.__dirty_keys = set()
+        self.__shape_dirty = True
+        _, self.__shape_subscription = obj.state_subscribe(self.__shape_changed, context)
+    
+    def get_object(self):
+        return self.__object
+    
+    def get_json(self):
+        if self.__shape_dirty:
+            self.__update_shape()
+        json = None  # copied on first actual change
+        for key in self.__dirty_keys:
+            cell = self.__cells[key]
+            if cell.type().is_reference():
+                value = self.__get_child(key, cell.get()).get_json()
+            else:
+                value = cell.get()
+            if key not in self.__json or not _same_json(self.__json[key], value):
+                if json is None:
+                    json = dict(self.__json)
+                json[key] = value
+        self.__dirty_keys.clear()
+        if json is not None:
+            self.__json = json
+        return self.__json
+    
+    def close(self):
+        self.__shape_subscription.unsubscribe()
+        for key in list(self.__cells):
+            self.__remove_key(key)
+    
+    def __get_child(self, key, obj):
+        child = self.__children.get(key)
+        if child is not None and child.get_object() is obj:
+            return child
+        if child is not None:
+            child.close()
+        child = self.__children[key] = _SnapshotNode(obj, self.__context, lambda: self.__key_changed(key))
+        return child
+    
+    def __update_shape(self):
+        """Subscribe to cells which have been added or replaced since the last update, and forget removed ones."""
+        self.__shape_dirty = False
+        cells = {key: cell for key, cell in six.iteritems(self.__object.state()) if cell.metadata().persists}
+        for key, old_cell in list(six.iteritems(self.__cells)):
+            if cells.get(key) is not old_cell:
+                self.__remove_key(key)
+        for key, cell in six.iteritems(cells):
+            if key not in self.__cells:
+                self.__cells[key] = cell
+                _, self.__subscriptions[key] = cell.subscribe2(self.__subscriber_for(key), self.__context)
+                self.__dirty_keys.add(key)
+    
+    def __remove_key(self, key):
+        del self.__cells[key]
+        self.__subscriptions.pop(key).unsubscribe()
+        child = self.__children.pop(key, None)
+        if child is not None:
+            child.close()
+        self.__dirty_keys.discard(key)
+        if key in self.__json:
+            self.__json = dict(self.__json)
+            del self.__json[key]
+    
+    def __subscriber_for(self, key):
+        return lambda _value: self.__key_changed(key)
+    
+    def __key_changed(self, key):
+        was_clean = self.__is_clean()
+        self.__dirty_keys.add(key)
+        if was_clean:
+            self.__on_dirty()
+    
+    def __shape_changed(self, _state):
+        was_clean = self.__is_clean()
+        self.__shape_dirty = True
+        if was_clean:
+            self.__on_dirty()
+    
+    def __is_clean(self):
+        return not self.__dirty_keys and not self.__shape_dirty
+
+
+def _same_json(old, new):
+    # Unchanged objects are always identical, so dicts need not be compared deeply.
+    if old is new:
+        return True
+    # pylint: disable=unidiomatic-typecheck
+    return type(old) == type(new) and not isinstance(new, dict) and old == new
+
+
+def json_patch(old, new):
+    """Return a list of JSON Patch (RFC 6902) operations which change the JSON value old into new.
+    
+    Objects (dicts) are compared key by key, and subtrees which are the same Python object are skipped without being examined, so that comparing snapshots from StateSnapshotter takes time proportional to their differences. Other values, including lists, are replaced as a whole.
+    """
+    operations = []
+    _json_patch_into(old, new, '', operations)
+    return operations
+
+
+__all__.append('json_patch')
+
+
+def _json_patch_into(old, new, path, operations):
+    if old is new:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                operations.append({'op': 'remove', 'path': path + '/' + _escape_pointer(key)})
+        for key, new_value in six.iteritems(new):
+            key_path = path + '/' + _escape_pointer(key)
+            if key in old:
+                _json_patch_into(old[key], new_value, key_path, operations)
+            else:
+                operations.append({'op': 'add', 'path': key_path, 'value': new_value})
+    elif not _same_json(old, new):
+        operations.append({'op': 'replace', 'path': path, 'value': new})
+
+
+def _escape_pointer(key):
+    """Escape a key for use in a JSON Pointer (RFC 6901)."""
+    return six.text_type(key).replace('~', '~0').replace('/', '~1')
+
+
+def _parse_pointer(path):
+    """Return the list of keys in a JSON Pointer (RFC 6901) as produced by json_patch."""
+    if path == '':
+        return []
+    if not path.startswith('/'):
+        raise ValueError('Not a JSON Pointer: {!r}'.format(path))
+    return [token.replace('~1', '/').replace('~0', '~') for token in path[1:].split('/')]
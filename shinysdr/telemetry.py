@@ -23,6 +23,7 @@ TODO: This doesn't actually deserve its own module; it's just not clear where to
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from collections import namedtuple
+import heapq
 
 import six
 
@@ -176,57 +177,112 @@ class TelemetryStore(CollectionState):
         CollectionState.__init__(self, self.__interesting_objects)
         self.__objects = {}
         self.__expiry_times = {}
+        # Min-heap of (expiry, object_id). Entries are not removed when an object's expiry changes; instead, an entry is stale (and skipped) if it does not match __expiry_times.
+        self.__expiry_heap = []
         self.__time_source = IReactorTime(time_source)
         self.__flush_call = None
+        self.__flush_time = None
 
     # not exported
     def receive(self, message):
         """Store the supplied telemetry message object."""
-        message = ITelemetryMessage(message)
-        object_id = six.text_type(message.get_object_id())
+        self.receive_many([message])
 
-        if object_id in self.__objects:
-            obj = self.__objects[object_id]
-        else:
-            obj = self.__objects[object_id] = ITelemetryObject(
-                # TODO: Should probably have a context object supplying last message time and delete_me()
-                message.get_object_constructor()(object_id=object_id))
-
-        obj.receive(message)
-        expiry = obj.get_object_expiry()
-        self.__expiry_times[object_id] = expiry
-        if obj.is_interesting():
-            self.__interesting_objects[object_id] = obj
-
-        self.__maybe_schedule_flush()
+    # not exported
+    def receive_many(self, messages):
+        """Store all of the supplied telemetry message objects.
+        
+        This is equivalent to calling receive() on each message in order, but cheaper for bursts of messages: each object is looked up once, and the expiry timer and shape change notification are updated at most once per call.
+        """
+        messages_by_id = {}
+        object_ids = []  # preserve arrival order of objects
+        for message in messages:
+            message = ITelemetryMessage(message)
+            object_id = six.text_type(message.get_object_id())
+            if object_id in messages_by_id:
+                messages_by_id[object_id].append(message)
+            else:
+                messages_by_id[object_id] = [message]
+                object_ids.append(object_id)
+
+        objects = self.__objects
+        expiry_times = self.__expiry_times
+        newly_interesting = {}
+        earliest_expiry = None
+        for object_id in object_ids:
+            object_messages = messages_by_id[object_id]
+            if object_id in objects:
+                obj = objects[object_id]
+            else:
+                obj = objects[object_id] = ITelemetryObject(
+                    # TODO: Should probably have a context object supplying last message time and delete_me()
+                    object_messages[0].get_object_constructor()(object_id=object_id))
+
+            for message in object_messages:
+                obj.receive(message)
+            expiry = obj.get_object_expiry()
+            if expiry_times.get(object_id) != expiry:
+                expiry_times[object_id] = expiry
+                heapq.heappush(self.__expiry_heap, (expiry, object_id))
+            if earliest_expiry is None or expiry < earliest_expiry:
+                earliest_expiry = expiry
+            if obj.is_interesting():
+                newly_interesting[object_id] = obj
+
+        if not object_ids:
+            return
+        self.__maybe_compact_heap()
+        self.__interesting_objects.update(newly_interesting)
+        self.__maybe_schedule_flush(earliest_expiry)
 
     def __flush_expired(self):
+        self.__flush_call = None
+        self.__flush_time = None
         current_time = self.__time_source.seconds()
-        deletes = []
-        for object_id, expiry in six.iteritems(self.__expiry_times):
-            if expiry <= current_time:
-                deletes.append(object_id)
-        for object_id in deletes:
+        heap = self.__expiry_heap
+        expiry_times = self.__expiry_times
+        while heap and heap[0][0] <= current_time:
+            expiry, object_id = heapq.heappop(heap)
+            if expiry_times.get(object_id) != expiry:
+                # stale entry; the object was updated or already deleted
+                continue
             del self.__objects[object_id]
-            del self.__expiry_times[object_id]
+            del expiry_times[object_id]
             if object_id in self.__interesting_objects:
                 del self.__interesting_objects[object_id]
-
-        self.__maybe_schedule_flush()
-
-    def __maybe_schedule_flush(self):
-        """Schedule a call to __flush_expired if there is not one already."""
+        self.__discard_stale_heap_top()
+
+        if heap:
+            self.__maybe_schedule_flush(heap[0][0])
+
+    def __discard_stale_heap_top(self):
+        """Remove stale entries from the top of the heap so that heap[0] is the true next expiry."""
+        heap = self.__expiry_heap
+        expiry_times = self.__expiry_times
+        while heap and expiry_times.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def __maybe_compact_heap(self):
+        """Rebuild the heap if it is mostly stale entries, to bound memory use."""
+        heap = self.__expiry_heap
+        if len(heap) > 2 * len(self.__expiry_times) + 64:
+            heap[:] = [(expiry, object_id) for object_id, expiry in six.iteritems(self.__expiry_times)]
+            heapq.heapify(heap)
+
+    def __maybe_schedule_flush(self, expiry):
+        """Schedule a call to __flush_expired at the given time if there is not one already scheduled no later than it."""
         if self.__flush_call and self.__flush_call.active():
-            # Could need to schedule one earlier than already scheduled.
+            if self.__flush_time <= expiry:
+                return
+            # Need to schedule one earlier than already scheduled.
             self.__flush_call.cancel()
 
-        if self.__expiry_times:
-            now = self.__time_source.seconds()
-            next_expiry = min(six.itervalues(self.__expiry_times))
-            sec_until_expiry = max(0, next_expiry - now)
-            self.__flush_call = self.__time_source.callLater(
-                sec_until_expiry,
-                self.__flush_expired)
+        now = self.__time_source.seconds()
+        sec_until_expiry = max(0, expiry - now)
+        self.__flush_time = expiry
+        self.__flush_call = self.__time_source.callLater(
+            sec_until_expiry,
+            self.__flush_expired)
 
 
 __all__.append('TelemetryStore')
@@ -0,0 +1,50 @@
+# Copyright 2017 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from twisted.trial import unittest
+
+from shinysdr.benchmark_filters import compare_results
+
+
+def _results(samples_per_second, design_seconds):
+    return {'results': [{
+        'kind': 'MultistageChannelFilter',
+        'input_rate': 2400000,
+        'output_rate': 48000,
+        'samples_per_second': samples_per_second,
+        'design_seconds': design_seconds,
+    }]}
+
+
+class TestCompareResults(unittest.TestCase):
+    def test_no_regression(self):
+        self.assertEqual([], compare_results(_results(1000, 0.01), _results(950, 0.0105), 0.1))
+    
+    def test_throughput_regression(self):
+        self.assertEqual(
+            ['MultistageChannelFilter 2400000 -> 48000: throughput decreased by 20%'],
+            compare_results(_results(1000, 0.01), _results(800, 0.01), 0.1))
+    
+    def test_design_regression(self):
+        self.assertEqual(
+            ['MultistageChannelFilter 2400000 -> 48000: design time increased from 0.0100 s to 0.0200 s'],
+            compare_results(_results(1000, 0.01), _results(1000, 0.02), 0.1))
+    
+    def test_new_case_ignored(self):
+        self.assertEqual([], compare_results({'results': []}, _results(1, 1), 0.1))
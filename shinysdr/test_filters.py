@@ -17,14 +17,20 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from math import pi, sin, cos
+import os
+import os.path
 import textwrap
 
+from twisted.internet import task
 from twisted.trial import unittest
 
 from gnuradio import blocks
 from gnuradio import gr
+from gnuradio.fft import window
 
-from shinysdr.filters import MultistageChannelFilter
+from shinysdr.filters import MultistageChannelFilter, SharedChannelizer, design_sawtooth_filter, _TapFileCache, _choose_stage_decimations, _divisors, _filter_plan_cache
+from shinysdr.values import SubscriptionContext, state_batch
 
 
 class TestMultistageChannelFilter(unittest.TestCase):
@@ -38,15 +44,13 @@ class TestMultistageChannelFilter(unittest.TestCase):
         self.assertEqual(1000, filt.get_transition_width())
         self.assertEqual(10000, filt.get_center_freq())
         self.assertEqual(filt.explain(), textwrap.dedent("""\
-            7 stages from 32000000 to 16000
-              freq xlate and decimate by 5 using  25 taps (160000000) in freq_xlating_fir_filter_ccc_sptr
-              decimate by 5 using  25 taps (32000000) in fft_filter_ccc_sptr
-              decimate by 5 using  25 taps (6400000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (1408000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (704000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (352000) in fft_filter_ccc_sptr
+            4 stages from 32000000 to 16000
+              freq xlate and decimate by 50 using 243 taps (155520000) in freq_xlating_fir_filter_ccc_sptr
+              decimate by 10 using  53 taps (3392000) in fir_filter_ccc_sptr
+              decimate by 2 using  11 taps (352000) in fir_filter_ccc_sptr
               final filter and decimate by 2 using  77 taps (1232000) in fft_filter_ccc_sptr
-              No final resampler stage."""))
+              No final resampler stage.
+              Estimated cost 9979.6 MACs per output sample."""))
     
     def test_too_wide_cutoff(self):
         self.assertRaisesRegexp(ValueError, '500.*182', MultistageChannelFilter, input_rate=200000, output_rate=182, cutoff_freq=500, transition_width=18.2)
@@ -55,29 +59,25 @@ class TestMultistageChannelFilter(unittest.TestCase):
         # TODO: Test filter functionality more
         f = MultistageChannelFilter(input_rate=32000000, output_rate=16000, cutoff_freq=3000, transition_width=1200)
         self.__run(f, 400000, 16000 / 32000000, """\
-            7 stages from 32000000 to 16000
-              freq xlate and decimate by 5 using  25 taps (160000000) in freq_xlating_fir_filter_ccc_sptr
-              decimate by 5 using  25 taps (32000000) in fft_filter_ccc_sptr
-              decimate by 5 using  25 taps (6400000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (1408000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (704000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (352000) in fft_filter_ccc_sptr
+            4 stages from 32000000 to 16000
+              freq xlate and decimate by 50 using 243 taps (155520000) in freq_xlating_fir_filter_ccc_sptr
+              decimate by 10 using  53 taps (3392000) in fir_filter_ccc_sptr
+              decimate by 2 using  11 taps (352000) in fir_filter_ccc_sptr
               final filter and decimate by 2 using  65 taps (1040000) in fft_filter_ccc_sptr
-              No final resampler stage.""")
+              No final resampler stage.
+              Estimated cost 9978.0 MACs per output sample.""")
     
     def test_float_rates(self):
         # Either float or int rates should be accepted
         f = MultistageChannelFilter(input_rate=32000000.0, output_rate=16000.0, cutoff_freq=3000, transition_width=1200)
         self.__run(f, 400000, 16000 / 32000000, """\
-            7 stages from 32000000 to 16000
-              freq xlate and decimate by 5 using  25 taps (160000000) in freq_xlating_fir_filter_ccc_sptr
-              decimate by 5 using  25 taps (32000000) in fft_filter_ccc_sptr
-              decimate by 5 using  25 taps (6400000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (1408000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (704000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (352000) in fft_filter_ccc_sptr
+            4 stages from 32000000 to 16000
+              freq xlate and decimate by 50 using 243 taps (155520000) in freq_xlating_fir_filter_ccc_sptr
+              decimate by 10 using  53 taps (3392000) in fir_filter_ccc_sptr
+              decimate by 2 using  11 taps (352000) in fir_filter_ccc_sptr
               final filter and decimate by 2 using  65 taps (1040000) in fft_filter_ccc_sptr
-              No final resampler stage.""")
+              No final resampler stage.
+              Estimated cost 9978.0 MACs per output sample.""")
     
     def test_interpolating(self):
         """Output rate higher than input rate"""
@@ -86,7 +86,8 @@ class TestMultistageChannelFilter(unittest.TestCase):
         self.__run(f, 4000, 20000 / 8000, """\
             2 stages from 8000 to 20000
               freq xlation only using   1 taps (8000) in freq_xlating_fir_filter_ccc_sptr
-              rational_resampler by 5/2 (stage rates 20000/8000) using 165 taps (3300000) in rational_resampler_base_ccf_sptr""")
+              rational_resampler by 5/2 (stage rates 20000/8000) using 165 taps (3300000) in rational_resampler_base_ccf_sptr
+              Estimated cost 16.9 MACs per output sample.""")
     
     def test_odd_interpolating(self):
         """Output rate higher than input rate and not a multiple"""
@@ -95,22 +96,19 @@ class TestMultistageChannelFilter(unittest.TestCase):
         self.__run(f, 4000, 21234 / 8000, """\
             2 stages from 8000 to 21234
               freq xlation only using   1 taps (8000) in freq_xlating_fir_filter_ccc_sptr
-              rational_resampler by 10617/4000 (stage rates 21234/8000) using 350361 taps (7439565474) in rational_resampler_base_ccf_sptr""")
+              rational_resampler by 10617/4000 (stage rates 21234/8000) using 350361 taps (7439565474) in rational_resampler_base_ccf_sptr
+              Estimated cost 16.9 MACs per output sample.""")
     
     def test_decimating(self):
         """Sample problematic decimation case"""
         # TODO: Test filter functionality more
         f = MultistageChannelFilter(input_rate=8000000, output_rate=48000, cutoff_freq=10000, transition_width=5000)
         self.__run(f, 400000, 48000 / 8000000, """\
-            8 stages from 8000000 to 48000
-              freq xlate and decimate by 2 using   9 taps (36000000) in freq_xlating_fir_filter_ccc_sptr
-              decimate by 2 using   9 taps (18000000) in fir_filter_ccc_sptr
-              decimate by 2 using   9 taps (9000000) in fir_filter_ccc_sptr
-              decimate by 2 using   9 taps (4500000) in fir_filter_ccc_sptr
-              decimate by 2 using  11 taps (2750000) in fft_filter_ccc_sptr
-              decimate by 2 using  11 taps (1375000) in fft_filter_ccc_sptr
-              final filter and decimate by 2 using  61 taps (3812500) in fft_filter_ccc_sptr
-              rational_resampler by 96/125 (stage rates 48000/62500) using 4128 taps (198144000) in rational_resampler_base_ccf_sptr""")
+            3 stages from 8000000 to 48000
+              freq xlate and decimate by 16 using  79 taps (39500000) in freq_xlating_fir_filter_ccc_sptr
+              decimate by 4 using  21 taps (2625000) in fir_filter_ccc_sptr
+              final filter and rational_resampler by 48/125 (stage rates 48000/125000) using 2891 taps (138768000) in rational_resampler_base_ccf_sptr
+              Estimated cost 907.7 MACs per output sample.""")
     
     def test_center_freq_decimating(self):
         f = MultistageChannelFilter(input_rate=10000, output_rate=1000, cutoff_freq=400, transition_width=200, center_freq=1)
@@ -131,7 +129,97 @@ class TestMultistageChannelFilter(unittest.TestCase):
             2 stages from 10000 to 1000
               freq xlate and decimate by 5 using  43 taps (86000) in freq_xlating_fir_filter_ccc_sptr
               final filter and decimate by 2 using  49 taps (49000) in fft_filter_ccc_sptr
-              No final resampler stage."""))
+              No final resampler stage.
+              Estimated cost 111.6 MACs per output sample."""))
+    
+    def test_describe(self):
+        f = MultistageChannelFilter(input_rate=10000, output_rate=1000, cutoff_freq=500, transition_width=100)
+        description = f.describe()
+        self.assertEqual(10000, description['input_rate'])
+        self.assertEqual(1000, description['output_rate'])
+        self.assertApproximates(111600, description['mac_per_second'], 1)
+        self.assertApproximates(21 / 10000 + 24 / 2000, description['group_delay'], 1e-9)
+        stages = description['stages']
+        self.assertEqual(
+            [(10000, 2000, 43, 'freq_xlating_fir_filter_ccc_sptr'), (2000, 1000, 49, 'fft_filter_ccc_sptr'), (1000, 1000, None, None)],
+            [(d['input_rate'], d['output_rate'], d['taps'], d['block']) for d in stages])
+        self.assertEqual('final filter and decimate by 2', stages[1]['description'])
+        self.assertEqual(description, f.state()['description'].get())
+        
+        f.set_transition_width(200)
+        self.assertEqual(25, f.state()['description'].get()['stages'][1]['taps'])
+    
+    def test_description_polled_only_on_plan_change(self):
+        f = MultistageChannelFilter(input_rate=10000, output_rate=1000, cutoff_freq=500, transition_width=100)
+        calls = []
+        describe = f.describe
+        f.describe = lambda: calls.append(None) or describe()
+        clock = task.Clock()
+        updates = []
+        f.state()['description'].subscribe2(updates.append, SubscriptionContext(reactor=clock, poller=None))
+        f.state_changed('description')
+        f.state_changed('description')
+        self.assertEqual(2, len(calls))  # subscribe2 and first poll
+        f.set_transition_width(200)
+        self.assertEqual(3, len(calls))
+        clock.advance(1)
+        self.assertEqual(25, updates[-1]['stages'][1]['taps'])
+    
+    def test_batched_redesign(self):
+        f = MultistageChannelFilter(input_rate=10000, output_rate=1000, cutoff_freq=500, transition_width=100)
+        redesigns = []
+        do_taps = f._MultistageChannelFilter__do_taps
+        f._MultistageChannelFilter__do_taps = lambda: redesigns.append(None) or do_taps()
+        with state_batch():
+            f.set_cutoff_freq(400)
+            f.set_transition_width(200)
+            self.assertEqual([], redesigns)
+        self.assertEqual(1, len(redesigns))
+        self.assertEqual(25, f.describe()['stages'][1]['taps'])
+    
+    def test_set_rates_in_place(self):
+        f = MultistageChannelFilter(input_rate=1000000, output_rate=50000, cutoff_freq=10000, transition_width=2000, center_freq=1000)
+        stages = list(f.stages)
+        self.assertTrue(f.set_rates(1200000, 60000))
+        self.assertEqual(stages, f.stages)
+        self.assertTrue(f.explain().startswith('3 stages from 1200000 to 60000\n'))
+        self.assertEqual(1000, f.get_center_freq())
+        self.assertEqual(10000, f.get_cutoff_freq())
+        f.set_center_freq(2000)
+        self.assertEqual(2000, f.get_center_freq())
+    
+    def test_set_rates_needs_rebuild(self):
+        f = MultistageChannelFilter(input_rate=1000000, output_rate=50000, cutoff_freq=10000, transition_width=2000)
+        explanation = f.explain()
+        self.assertFalse(f.set_rates(2400000, 48000))
+        self.assertEqual(explanation, f.explain())
+        self.assertRaises(ValueError, f.set_rates, 1000000, 10000)
+    
+    def test_plan_cache(self):
+        _filter_plan_cache.clear()
+        f1 = MultistageChannelFilter(input_rate=1000000, output_rate=24000, cutoff_freq=5000, transition_width=1000)
+        self.assertEqual((0, 2), (_filter_plan_cache.hits, _filter_plan_cache.misses))
+        f2 = MultistageChannelFilter(input_rate=1000000, output_rate=24000, cutoff_freq=5000, transition_width=1000)
+        self.assertEqual((1, 2), (_filter_plan_cache.hits, _filter_plan_cache.misses))
+        self.assertEqual(f1.explain(), f2.explain())
+        
+        # changing the cutoff reuses the untapped plan
+        f1.set_cutoff_freq(4000)
+        self.assertEqual((2, 3), (_filter_plan_cache.hits, _filter_plan_cache.misses))
+        f2.set_cutoff_freq(4000)
+        self.assertEqual((3, 3), (_filter_plan_cache.hits, _filter_plan_cache.misses))
+        self.assertEqual(4000, f2.get_cutoff_freq())
+        self.assertEqual(f1.explain(), f2.explain())
+    
+    def test_stage_decimations(self):
+        self.assertEqual([1, 2, 3, 4, 6, 12], _divisors(12))
+        for input_rate, output_rate, total_decimation in [(32000000, 16000, 2000), (2400000, 48000, 50), (10000, 1000, 7)]:
+            decimations = _choose_stage_decimations(input_rate, output_rate, total_decimation)
+            product = 1
+            for d in decimations:
+                product *= d
+            self.assertEqual(total_decimation, product)
+        self.assertEqual([], _choose_stage_decimations(1000, 1000, 1))
     
     def __run(self, f, in_size, ratio, explanation):
         """check that the actual relative rate is as expected"""
@@ -158,3 +246,102 @@ class TestMultistageChannelFilter(unittest.TestCase):
         top.stop()
         reference_out_size = in_size * ratio
         return reference_out_size - len(sink.data())
+
+
+class TestSharedChannelizer(unittest.TestCase):
+    def setUp(self):
+        self.channelizer = SharedChannelizer(input_rate=2400000, channel_count=20)
+    
+    def test_rates(self):
+        self.assertEqual(120000, self.channelizer.get_channel_spacing())
+        self.assertEqual(240000, self.channelizer.get_channel_rate())
+    
+    def test_find_channel(self):
+        c = self.channelizer
+        self.assertEqual((0, 0), c.find_channel(0, 5000, 1000))
+        self.assertEqual((1, 10000), c.find_channel(130000, 5000, 1000))
+        self.assertEqual((19, -10000), c.find_channel(-130000, 5000, 1000))
+        self.assertEqual((10, 0), c.find_channel(1200000, 5000, 1000))
+        # halfway between sub-channels, too wide for either
+        self.assertEqual(None, c.find_channel(60000, 20000, 1000))
+    
+    def test_make_channel_filter(self):
+        index, f = self.channelizer.make_channel_filter(output_rate=48000, cutoff_freq=5000, transition_width=1000, center_freq=250000)
+        self.assertEqual(2, index)
+        self.assertEqual(10000, f.get_center_freq())
+        self.assertIn('from 240000 to 48000', f.explain())
+    
+    def test_bad_channel_count(self):
+        self.assertRaises(ValueError, SharedChannelizer, input_rate=1000000, channel_count=5, oversample_rate=2)
+
+
+class TestSawtoothFilter(unittest.TestCase):
+    def test_matches_formula(self):
+        for ntaps in [1, 2, 7, 40]:
+            for decreasing in [False, True]:
+                expected = _reference_sawtooth_filter(ntaps, decreasing)
+                actual = design_sawtooth_filter(ntaps=ntaps, decreasing=decreasing)
+                self.assertEqual(ntaps, len(actual))
+                for a, b in zip(expected, actual):
+                    self.assertApproximates(a, b, 1e-12)
+    
+    def test_not_shared(self):
+        taps = design_sawtooth_filter(ntaps=20)
+        self.assertIsInstance(taps, list)
+        expected = list(taps)
+        taps[0] = 0
+        self.assertEqual(expected, design_sawtooth_filter(ntaps=20))
+
+
+def _reference_sawtooth_filter(ntaps, decreasing):
+    # straightforward version of the formula to check design_sawtooth_filter against
+    window_values = window.build(window.WIN_HAMMING, ntaps, 0)
+    taps = []
+    for i in range(0, ntaps):
+        k = i - ntaps // 2
+        if k == 0:
+            ideal_response = complex(pi, 0)
+        else:
+            ideal_response = complex(0, sin(pi * k) / (pi * k * k) - cos(pi * k) / k)
+        taps.append(window_values[i] * ideal_response)
+    gain_factor = 1.0 / abs(sum(taps))
+    taps = [tap * gain_factor for tap in taps]
+    return taps[::-1] if decreasing else taps
+
+
+class TestTapFileCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.designs = 0
+    
+    def __design(self, value):
+        def design():
+            self.designs += 1
+            return [value] * 100
+        return design
+    
+    def test_reuse(self):
+        cache = _TapFileCache(self.directory, max_bytes=10000)
+        taps = cache.get_or_design(('a', 1), self.__design(1.0))
+        self.assertEqual([1.0] * 100, list(taps))
+        self.assertEqual(1, self.designs)
+        # a new cache object stands in for restarting
+        cache = _TapFileCache(self.directory, max_bytes=10000)
+        taps = cache.get_or_design(('a', 1), self.__design(1.0))
+        self.assertEqual([1.0] * 100, list(taps))
+        self.assertEqual(1, self.designs)
+        self.assertFalse(taps.flags.writeable)
+        cache.get_or_design(('a', 2), self.__design(2.0))
+        self.assertEqual(2, self.designs)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+    
+    def test_eviction(self):
+        # each file is 100 doubles plus a header
+        cache = _TapFileCache(self.directory, max_bytes=2000)
+        cache.get_or_design(('a', 1), self.__design(1.0))
+        os.utime(os.path.join(self.directory, os.listdir(self.directory)[0]), (0, 0))  # make it the oldest
+        cache.get_or_design(('a', 2), self.__design(2.0))
+        cache.get_or_design(('a', 3), self.__design(3.0))
+        self.assertEqual(2, len(os.listdir(self.directory)))
+        cache.get_or_design(('a', 1), self.__design(1.0))
+        self.assertEqual(4, self.designs)
@@ -0,0 +1,167 @@
+# Copyright 2018 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import os.path
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from shinysdr import journal as journal_module
+from shinysdr.journal import StateJournal
+from shinysdr.types import ReferenceT
+from shinysdr.values import ExportedState, SubscriptionContext, exported_value, nullExportedState, setter
+
+
+class TestStateJournal(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        directory = self.mktemp()
+        os.mkdir(directory)
+        self.filename = os.path.join(directory, 'state.json')
+        self.journals = []
+    
+    def tearDown(self):
+        for journal in self.journals:
+            journal.close()
+    
+    def __open(self, **kwargs):
+        root = JournalSpecimen(JournalSpecimen())
+        journal = StateJournal(root, self.filename, SubscriptionContext(reactor=self.clock, poller=None), reactor=self.clock, write_delay=1, **kwargs)
+        self.journals.append(journal)
+        return root, journal
+    
+    def __read_snapshot(self):
+        with open(self.filename, 'r') as f:
+            return json.load(f)
+    
+    def __read_journal(self):
+        with open(self.filename + '.journal', 'r') as f:
+            return [json.loads(line) for line in f]
+    
+    def test_defaults_and_snapshot(self):
+        root, _ = self.__open(get_defaults=lambda _: {'value': 3})
+        self.assertEqual(3, root.get_value())
+        self.assertEqual({'value': 3, 'block': {'value': 0, 'block': {}}}, self.__read_snapshot())
+        self.assertEqual([], self.__read_journal())
+    
+    def test_journal_and_replay(self):
+        root, _ = self.__open()
+        root.get_block().set_value(5)
+        self.clock.advance(0)  # notification
+        self.assertEqual([], self.__read_journal())
+        self.clock.advance(1)  # write
+        self.assertEqual([{'op': 'replace', 'path': '/block/value', 'value': 5}], self.__read_journal())
+        self.assertEqual(0, self.__read_snapshot()['block']['value'])
+        
+        # simulate crash by not closing
+        self.journals.pop()
+        root_2, _ = self.__open()
+        self.assertEqual(5, root_2.get_block().get_value())
+        self.assertEqual(5, self.__read_snapshot()['block']['value'])
+        self.assertEqual([], self.__read_journal())
+    
+    def test_changes_batched(self):
+        root, _ = self.__open()
+        root.set_value(1)
+        self.clock.advance(0)
+        root.set_value(2)
+        self.clock.advance(0)
+        self.clock.advance(1)
+        self.assertEqual([{'op': 'replace', 'path': '/value', 'value': 2}], self.__read_journal())
+    
+    def test_compaction(self):
+        root, _ = self.__open(compact_threshold=2)
+        for i in range(3):
+            root.set_value(i + 1)
+            self.clock.advance(0)
+            self.clock.advance(1)
+        self.assertEqual(3, self.__read_snapshot()['value'])
+        self.assertEqual([], self.__read_journal())
+    
+    def test_truncated_journal(self):
+        root, _ = self.__open()
+        root.set_value(7)
+        self.clock.advance(0)
+        self.clock.advance(1)
+        self.journals.pop()
+        with open(self.filename + '.journal', 'ab') as f:
+            f.write(b'{"op": "repl')
+        root_2, _ = self.__open()
+        self.assertEqual(7, root_2.get_value())
+        self.flushLoggedErrors()
+    
+    def test_sync(self):
+        root, journal = self.__open()
+        root.set_value(4)
+        self.clock.advance(0)
+        journal.sync()
+        self.assertEqual([{'op': 'replace', 'path': '/value', 'value': 4}], self.__read_journal())
+        self.assertEqual([], self.clock.getDelayedCalls())
+    
+    def test_crash_during_compaction(self):
+        root, journal = self.__open()
+        root.set_value(1)
+        self.clock.advance(0)
+        self.clock.advance(1)
+        root.set_value(2)  # not yet written to the journal
+        self.clock.advance(0)
+        
+        def write_then_crash(filename, data):
+            original_write(filename, data)
+            raise IOError('simulated crash')
+        
+        original_write = journal_module._write_file_atomically
+        self.patch(journal_module, '_write_file_atomically', write_then_crash)
+        self.journals.remove(journal)
+        self.assertRaises(IOError, journal.close)
+        self.patch(journal_module, '_write_file_atomically', original_write)
+        
+        # the old journal is replayed onto the new snapshot
+        self.assertEqual(2, self.__read_journal()[-1]['value'])
+        root_2, _ = self.__open()
+        self.assertEqual(2, root_2.get_value())
+    
+    def test_close(self):
+        root, journal = self.__open()
+        root.set_value(9)
+        self.clock.advance(0)
+        self.journals.remove(journal)
+        journal.close()
+        self.assertEqual(9, self.__read_snapshot()['value'])
+        self.assertEqual([], self.__read_journal())
+
+
+class JournalSpecimen(ExportedState):
+    def __init__(self, block=nullExportedState):
+        self.__value = 0
+        self.__block = block
+    
+    @exported_value(type=ReferenceT(), changes='never')
+    def get_block(self):
+        return self.__block
+    
+    @exported_value(type=int, changes='this_setter')
+    def get_value(self):
+        return self.__value
+    
+    @setter
+    def set_value(self, value):
+        self.__value = value
@@ -0,0 +1,77 @@
+# Copyright 2017 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os.path
+
+import numpy
+
+from twisted.trial import unittest
+
+from shinysdr.offline_filter import OfflineChannel, OfflineChannelFilter, filter_recording
+
+
+def _tone(freq, rate, count):
+    return numpy.exp(2j * numpy.pi * freq / rate * numpy.arange(count)).astype(numpy.complex64)
+
+
+class TestOfflineChannelFilter(unittest.TestCase):
+    def test_selects_channel(self):
+        signal = _tone(2000, 10000, 20000) + 0.5 * _tone(-3000, 10000, 20000)
+        f = OfflineChannelFilter(input_rate=10000, output_rate=1000, cutoff_freq=400, transition_width=200, center_freq=2000)
+        out = f.process(signal)
+        self.assertEqual(2000, len(out))
+        # after the filter has settled, only the wanted tone remains, shifted to 0 Hz
+        settled = out[100:]
+        self.assertApproximates(1.0, numpy.mean(numpy.abs(settled)), 0.01)
+        self.assertApproximates(0.0, numpy.std(numpy.abs(settled)), 0.01)
+    
+    def test_chunking(self):
+        signal = (numpy.random.RandomState(0).randn(30000) + 0j).astype(numpy.complex64)
+        whole = OfflineChannelFilter(input_rate=8000, output_rate=48000, cutoff_freq=3000, transition_width=1000)
+        chunked = OfflineChannelFilter(input_rate=8000, output_rate=48000, cutoff_freq=3000, transition_width=1000)
+        expected = whole.process(signal)
+        actual = numpy.concatenate([chunked.process(signal[i:i + 777]) for i in range(0, len(signal), 777)])
+        self.assertEqual(len(signal) * 6, len(actual))
+        self.assertTrue(numpy.allclose(expected, actual, atol=1e-5))
+    
+    def test_rational_decimation(self):
+        f = OfflineChannelFilter(input_rate=250000, output_rate=48000, cutoff_freq=5000, transition_width=2000)
+        self.assertEqual(48000, len(f.process(numpy.zeros(250000, dtype=numpy.complex64))))
+
+
+class TestFilterRecording(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.abspath(self.mktemp())
+        (_tone(1000, 10000, 50000) + _tone(-2000, 10000, 50000)).tofile(self.filename)
+        self.channels = [
+            OfflineChannel(center_freq=1000, output_rate=1000, cutoff_freq=400, transition_width=200),
+            OfflineChannel(center_freq=-2000, output_rate=2000, cutoff_freq=400, transition_width=200),
+        ]
+    
+    def __check(self, outputs):
+        self.assertEqual([5000, 10000], [len(output) for output in outputs])
+        for output in outputs:
+            self.assertApproximates(1.0, numpy.mean(numpy.abs(output[200:])), 0.01)
+    
+    def test_sequential(self):
+        self.__check(filter_recording(self.filename, 10000, self.channels, chunk_size=4096))
+    
+    def test_processes(self):
+        self.__check(filter_recording(self.filename, 10000, self.channels, chunk_size=4096, processes=2))
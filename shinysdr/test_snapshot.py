@@ -0,0 +1,128 @@
+# Copyright 2018 Kevin Reid and the ShinySDR contributors
+# 
+# This file is part of ShinySDR.
+# 
+# ShinySDR is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ShinySDR is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ShinySDR.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from shinysdr.snapshot import StateSnapshotter, json_patch
+from shinysdr.types import ReferenceT
+from shinysdr.values import CellDict, CollectionState, ExportedState, SubscriptionContext, exported_value, nullExportedState, setter
+
+
+class TestStateSnapshotter(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.leaf_a = SnapshotSpecimen()
+        self.leaf_b = SnapshotSpecimen()
+        self.table = CellDict({'a': self.leaf_a}, dynamic=True)
+        self.root = SnapshotSpecimen(CollectionState(self.table))
+        self.snapshotter = StateSnapshotter(self.root, SubscriptionContext(reactor=self.clock, poller=None), history_length=3)
+    
+    def tearDown(self):
+        self.snapshotter.close()
+    
+    def test_matches_state_to_json(self):
+        version, state = self.snapshotter.snapshot()
+        self.assertEqual(self.root.state_to_json(), state)
+        self.clock.advance(0)
+        self.assertEqual((version, state), self.snapshotter.snapshot())
+    
+    def test_value_change(self):
+        version_1, state_1 = self.snapshotter.snapshot()
+        self.leaf_a.set_value(5)
+        self.clock.advance(0)
+        version_2, state_2 = self.snapshotter.snapshot()
+        self.assertNotEqual(version_1, version_2)
+        self.assertEqual(self.root.state_to_json(), state_2)
+        self.assertIs(state_1['value'], state_2['value'])
+        self.assertEqual(
+            [{'op': 'replace', 'path': '/block/a/value', 'value': 5}],
+            self.snapshotter.delta(version_1))
+    
+    def test_set_to_same_value(self):
+        version_1, _ = self.snapshotter.snapshot()
+        self.leaf_a.set_value(0)
+        self.clock.advance(0)
+        self.assertEqual(version_1, self.snapshotter.snapshot()[0])
+    
+    def test_shape_change(self):
+        version_1, _ = self.snapshotter.snapshot()
+        self.table['b'] = self.leaf_b
+        del self.table['a']
+        self.clock.advance(0)
+        version_2, state_2 = self.snapshotter.snapshot()
+        self.assertEqual(self.root.state_to_json(), state_2)
+        self.assertEqual(
+            [
+                {'op': 'remove', 'path': '/block/a'},
+                {'op': 'add', 'path': '/block/b', 'value': {'value': 0, 'block': {}}},
+            ],
+            self.snapshotter.delta(version_1, version_2))
+        
+        # the removed object is no longer watched
+        self.leaf_a.set_value(1)
+        self.clock.advance(0)
+        self.assertEqual(version_2, self.snapshotter.snapshot()[0])
+        self.leaf_b.set_value(1)
+        self.clock.advance(0)
+        self.assertEqual(self.root.state_to_json(), self.snapshotter.snapshot()[1])
+    
+    def test_history_length(self):
+        version_1, _ = self.snapshotter.snapshot()
+        for i in range(3):
+            self.leaf_a.set_value(i + 1)
+            self.clock.advance(0)
+            self.snapshotter.snapshot()
+        self.assertEqual(None, self.snapshotter.delta(version_1))
+        self.assertEqual([], self.snapshotter.delta(self.snapshotter.get_version()))
+
+
+class TestJsonPatch(unittest.TestCase):
+    def test_escaping(self):
+        self.assertEqual(
+            [{'op': 'add', 'path': '/a~1b~0c', 'value': 1}],
+            json_patch({}, {'a/b~c': 1}))
+    
+    def test_type_change(self):
+        self.assertEqual(
+            [{'op': 'replace', 'path': '/x', 'value': True}],
+            json_patch({'x': 1}, {'x': True}))
+    
+    def test_root_replace(self):
+        self.assertEqual(
+            [{'op': 'replace', 'path': '', 'value': [2]}],
+            json_patch([1], [2]))
+
+
+class SnapshotSpecimen(ExportedState):
+    def __init__(self, block=nullExportedState):
+        self.__value = 0
+        self.__block = block
+    
+    @exported_value(type=ReferenceT(), changes='never')
+    def get_block(self):
+        return self.__block
+    
+    @exported_value(type=int, changes='this_setter')
+    def get_value(self):
+        return self.__value
+    
+    @setter
+    def set_value(self, value):
+        self.__value = value
@@ -22,6 +22,7 @@ from twisted.trial import unittest
 from zope.interface import implementer
 
 from shinysdr.telemetry import ITelemetryMessage, ITelemetryObject, TelemetryItem, TelemetryStore, Track, empty_track
+from shinysdr.values import SubscriptionContext
 
 
 class TestTrack(unittest.TestCase):
@@ -73,6 +74,27 @@ class TestTelemetryStore(unittest.TestCase):
         # Expect complete cleanup -- that is, even if a TelemetryStore is created, filled, and thrown away, it will eventually be garbage collected when the objects expire.
         self.assertEqual(set(), set(self.clock.getDelayedCalls()))
     
+    def test_receive_many(self):
+        shape_changes = []
+        self.store.state_subscribe(shape_changes.append, SubscriptionContext(reactor=self.clock, poller=None))
+        self.store.receive_many([
+            Msg('foo', 1000, 1),
+            Msg('bar', 1000, 'boring'),
+            Msg('foo', 1001, 2),
+            Msg('bar', 1001, 3),
+        ])
+        self.assertEqual({'foo', 'bar'}, set(self.store.state().keys()))
+        self.assertEqual(self.store.state()['foo'].get().last_msg, 2)
+        self.assertEqual(self.store.state()['bar'].get().last_msg, 3)
+        self.clock.advance(0)
+        self.assertEqual(1, len(shape_changes))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))  # the expiry timer
+    
+    def test_receive_many_empty(self):
+        self.store.receive_many([])
+        self.assertEqual(set(), set(self.store.state().keys()))
+        self.assertEqual(set(), set(self.clock.getDelayedCalls()))
+    
     def test_become_interesting(self):
         self.store.receive(Msg('foo', 1000, 'boring'))
         self.assertEqual(set(), set(self.store.state().keys()))
@@ -98,6 +120,27 @@ class TestTelemetryStore(unittest.TestCase):
         self.store.receive(Msg('foo', 0, 'long ago'))
         self.clock.advance(2000)
 
+    def test_refreshed_object_kept(self):
+        self.store.receive(Msg('foo', 1000))
+        self.clock.advance(1000)
+        self.store.receive(Msg('foo', 2000))
+        self.clock.advance(1000)
+        self.assertEqual({'foo'}, set(self.store.state().keys()))
+        self.clock.advance(1000)
+        self.assertEqual(set(), set(self.store.state().keys()))
+        self.assertEqual(set(), set(self.clock.getDelayedCalls()))
+    
+    def test_later_expiry_does_not_reschedule(self):
+        self.store.receive(Msg('foo', 1000))
+        calls = list(self.clock.getDelayedCalls())
+        self.assertEqual(1, len(calls))
+        self.store.receive(Msg('bar', 1001))
+        self.store.receive(Msg('foo', 1002))
+        self.assertEqual(calls, self.clock.getDelayedCalls())
+        self.store.receive(Msg('baz', 900))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.assertNotEqual(calls, self.clock.getDelayedCalls())
+
 
 class SlightlyBetterClock(Clock):
     def callLater(self, when, what, *a, **kw):
@@ -22,7 +22,9 @@ import six
 
 from twisted.trial import unittest
 
-from shinysdr.types import BulkDataElement, BulkDataT, ConstantT, EnumT, EnumRow, RangeT, to_value_type
+import numpy
+
+from shinysdr.types import BulkDataBlock, BulkDataElement, BulkDataT, ConstantT, EnumT, EnumRow, RangeT, to_value_type
 from shinysdr import units
 
 
@@ -80,6 +82,50 @@ class TestPythonT(unittest.TestCase):
         self.assertEqual(buf.get(), 'aabb')
         buf.append('cc')
         self.assertEqual(buf.get(), 'abbcc')
+    
+    def test_string_buffer_many_appends(self):
+        buf = to_value_type(six.text_type).create_buffer(history_length=7)
+        expected = ''
+        for i in six.moves.range(30):
+            patch = 'xyz'[:i % 4] + six.text_type(i)
+            buf.append(patch)
+            expected = (expected + patch)[-7:]
+            if i % 3 == 0:
+                self.assertEqual(buf.get(), expected)
+        self.assertEqual(buf.get(), expected)
+    
+    def test_string_buffer_prepend(self):
+        buf = to_value_type(six.text_type).create_buffer(history_length=5)
+        buf.append('cd')
+        buf.prepend('ab')
+        self.assertEqual(buf.get(), 'abcd')
+        buf.prepend('xy')
+        self.assertEqual(buf.get(), 'yabcd')
+        buf.prepend('ignored after truncation')
+        self.assertEqual(buf.get(), 'yabcd')
+    
+    def test_bytes_buffer_type(self):
+        buf = to_value_type(bytes).create_buffer(history_length=5)
+        self.assertEqual(buf.get(), b'')
+        self.assertIsInstance(buf.get(), bytes)
+    
+    def test_string_buffer_clear(self):
+        buf = to_value_type(bytes).create_buffer(history_length=5)
+        buf.append(b'abcdef')
+        buf.clear()
+        self.assertEqual(buf.get(), b'')
+        self.assertIsInstance(buf.get(), bytes)
+        buf.append(b'g')
+        buf.prepend(b'f')
+        self.assertEqual(buf.get(), b'fg')
+    
+    def test_string_diff(self):
+        value_type = to_value_type(six.text_type)
+        self.assertEqual(value_type.diff('abc', 'abcdef'), 'def')
+        self.assertEqual(value_type.diff('abc', 'xbcdef'), None)
+        self.assertEqual(value_type.diff('abc', 'abc'), None)
+        self.assertEqual(to_value_type(bytes).diff(b'ab', b'abc'), b'c')
+        self.assertEqual(to_value_type(int).diff(1, 2), None)
 
 
 class TestConstantT(unittest.TestCase):
@@ -255,6 +301,49 @@ class TestBulkData(unittest.TestCase):
             BulkDataElement(info=(123,), data=b'\xFF').to_json(),
             [(123,), [-1]])
     
+    def test_block_elements(self):
+        block = BulkDataBlock(info=(1,), array=numpy.array([[1, 2], [3, 4], [5, 6]], dtype=numpy.int8))
+        self.assertEqual(3, len(block))
+        self.assertEqual(block[1], BulkDataElement(info=(1,), data=b'\x03\x04'))
+        self.assertEqual(block[1:], [
+            BulkDataElement(info=(1,), data=b'\x03\x04'),
+            BulkDataElement(info=(1,), data=b'\x05\x06')])
+    
+    def test_block_pack_many(self):
+        bulk_type = BulkDataT(info_format='<H', array_format='f')
+        block = BulkDataBlock(info=(258,), array=numpy.array([[1.0, 2.0], [3.0, 4.0]], dtype=numpy.float32))
+        self.assertEqual(
+            bulk_type.pack_many(block),
+            b''.join(bulk_type.pack(element) for element in block))
+        self.assertEqual(
+            bulk_type.pack_many(list(block)),
+            bulk_type.pack_many(block))
+    
+    def test_block_concatenate_all(self):
+        blocks = [BulkDataBlock(info=(1,), array=numpy.array([[i, i]], dtype=numpy.int8)) for i in range(3)]
+        joined = BulkDataBlock.concatenate_all(blocks)
+        self.assertEqual(joined, BulkDataBlock(info=(1,), array=numpy.array([[0, 0], [1, 1], [2, 2]], dtype=numpy.int8)))
+        self.assertIs(blocks[0], BulkDataBlock.concatenate_all(blocks[:1]))
+        self.assertEqual(None, BulkDataBlock.concatenate_all([]))
+        self.assertEqual(None, BulkDataBlock.concatenate_all(blocks + [BulkDataBlock(info=(2,), array=numpy.array([[3, 3]], dtype=numpy.int8))]))
+        self.assertEqual(None, BulkDataBlock.concatenate_all(blocks + [list(blocks[0])]))
+    
+    def test_block_fingerprint(self):
+        bulk_type = BulkDataT(info_format='<H', array_format='b')
+        block = BulkDataBlock(info=(1,), array=numpy.array([[1, 2], [3, 4]], dtype=numpy.int8))
+        same = BulkDataBlock(info=(1,), array=numpy.array([[1, 2], [3, 4]], dtype=numpy.int8))
+        self.assertEqual(bulk_type.fingerprint(block), bulk_type.fingerprint(block))
+        # identity only, without examining the contents
+        self.assertNotEqual(bulk_type.fingerprint(block), bulk_type.fingerprint(same))
+    
+    def test_block_equality(self):
+        block = BulkDataBlock(info=(1,), array=numpy.array([[1, 2], [3, 4]], dtype=numpy.int8))
+        self.assertEqual(block, BulkDataBlock(info=(1,), array=numpy.array([[1, 2], [3, 4]], dtype=numpy.int8)))
+        self.assertNotEqual(block, BulkDataBlock(info=(2,), array=numpy.array([[1, 2], [3, 4]], dtype=numpy.int8)))
+        self.assertNotEqual(block, BulkDataBlock(info=(1,), array=numpy.array([[1, 2, 3, 4]], dtype=numpy.int8)))
+        self.assertNotEqual(block, BulkDataBlock(info=(1,), array=numpy.array([[1, 2], [3, 5]], dtype=numpy.int8)))
+        self.assertEqual(block, list(block))
+    
     def test_buffer_append_and_truncate(self):
         # TODO: add more tests
         buf = BulkDataT('', '').create_buffer(history_length=2)
@@ -267,3 +356,63 @@ class TestBulkData(unittest.TestCase):
         self.assertEqual(buf.get(), [
             BulkDataElement(info=(), data=b'\x02'),
             BulkDataElement(info=(), data=b'\x03')])
+    
+    def test_buffer_wraparound(self):
+        buf = BulkDataT('', '').create_buffer(history_length=5)
+        expected = []
+        for i in six.moves.range(20):
+            patch = [BulkDataElement(info=(), data=six.int2byte(j)) for j in six.moves.range(i, i + i % 4)]
+            buf.append(patch)
+            expected = (expected + patch)[-5:]
+            self.assertEqual(buf.get(), expected)
+    
+    def test_buffer_keeps_blocks(self):
+        bulk_type = BulkDataT(info_format='<H', array_format='b')
+        buf = bulk_type.create_buffer(history_length=5)
+        for i in six.moves.range(4):
+            buf.append(BulkDataBlock(info=(1,), array=numpy.array([[i, 0], [i, 1]], dtype=numpy.int8)))
+        value = buf.get()
+        self.assertIsInstance(value, BulkDataBlock)
+        self.assertEqual(value, BulkDataBlock(info=(1,), array=numpy.array([[1, 1], [2, 0], [2, 1], [3, 0], [3, 1]], dtype=numpy.int8)))
+        self.assertEqual(bulk_type.pack_many(value), b''.join(bulk_type.pack(element) for element in value))
+        
+        buf.append(BulkDataBlock(info=(2,), array=numpy.array([[4, 0]], dtype=numpy.int8)))
+        self.assertEqual(buf.get(), list(value)[1:] + [BulkDataElement(info=(2,), data=b'\x04\x00')])
+    
+    def test_buffer_values_not_mutated(self):
+        buf = BulkDataT('', '').create_buffer(history_length=3)
+        values = []
+        for i in six.moves.range(10):
+            buf.append(BulkDataBlock(info=(), array=numpy.array([[i]], dtype=numpy.int8)))
+            value = buf.get()
+            values.append((value, list(value)))
+        for value, expected in values:
+            self.assertEqual(expected, list(value))
+        self.assertEqual([b'\x07', b'\x08', b'\x09'], [e.data for e in buf.get()])
+    
+    def test_buffer_clear(self):
+        buf = BulkDataT('', '').create_buffer(history_length=2)
+        buf.append([BulkDataElement(info=(), data=b'\x01\x02')] * 3)
+        buf.clear()
+        self.assertEqual(buf.get(), [])
+        buf.append([BulkDataElement(info=(), data=b'\x03')])
+        buf.prepend([BulkDataElement(info=(), data=b'\x02')])
+        self.assertEqual(buf.get(), [
+            BulkDataElement(info=(), data=b'\x02'),
+            BulkDataElement(info=(), data=b'\x03')])
+    
+    def test_buffer_prepend(self):
+        buf = BulkDataT('', '').create_buffer(history_length=3)
+        buf.append([BulkDataElement(info=(), data=b'\x02')])
+        buf.prepend([BulkDataElement(info=(), data=b'\x00'), BulkDataElement(info=(), data=b'\x01')])
+        self.assertEqual(buf.get(), [
+            BulkDataElement(info=(), data=b'\x00'),
+            BulkDataElement(info=(), data=b'\x01'),
+            BulkDataElement(info=(), data=b'\x02')])
+        buf.append([BulkDataElement(info=(), data=b'\x03')])
+        # now truncated, so further prepends are ignored
+        buf.prepend([BulkDataElement(info=(), data=b'\xFF')])
+        self.assertEqual(buf.get(), [
+            BulkDataElement(info=(), data=b'\x01'),
+            BulkDataElement(info=(), data=b'\x02'),
+            BulkDataElement(info=(), data=b'\x03')])
@@ -22,14 +22,15 @@ import six
 
 from twisted.internet import defer
 from twisted.internet import reactor as the_reactor
-from twisted.internet.task import deferLater
+from twisted.internet.task import Clock, deferLater
 from twisted.trial import unittest
+from zope.interface import implementer
 
 import numpy
 
-from shinysdr.testutil import CellSubscriptionTester, LoopbackInterestTracker, LogTester
+from shinysdr.testutil import CellSubscriptionTester, LoopbackInterestTracker, LogTester, SubscriptionTester
 from shinysdr.types import BulkDataElement, BulkDataT, EnumRow, RangeT, ReferenceT, to_value_type
-from shinysdr.values import CellDict, CollectionState, ElementSinkCell, ExportedState, LooseCell, PollingCell, StringSinkCell, ViewCell, command, exported_value, nullExportedState, setter, unserialize_exported_state
+from shinysdr.values import BatchPoller, CellDict, CollectionState, ElementSinkCell, ExportedState, IShapeDeltaSubscriber, LooseCell, PollingCell, StringSinkCell, SubscriptionContext, ViewCell, after_state_batch, command, exported_value, nullExportedState, setter, state_batch, unserialize_exported_state
 
 
 class TestExportedState(unittest.TestCase):
@@ -90,6 +91,88 @@ class TestExportedState(unittest.TestCase):
         }, log=log_tester.log)
         log_tester.check(dict(text='Discarding erroneous state <Splodey>.foo = 1'))
     
+    def test_persistence_coerced_before_setting(self):
+        o = BatchSpecimen()
+        log_tester = LogTester()
+        o.state_from_json({
+            u'a': 1,
+            u'b': 'not a number',
+        }, log=log_tester.log)
+        log_tester.check(dict(text='Discarding erroneous state <BatchSpecimen>.b = not a number'))
+        self.assertEqual([(1.0, 0.0)], o.reconfigurations)
+    
+    def test_persistence_checked_before_setting(self):
+        log_tester = LogTester()
+        logged_when_set = []
+        
+        class Recorder(ExportedState):
+            def __repr__(self):
+                return '<Recorder>'  # no address
+            
+            @exported_value(type=float, changes='this_setter')
+            def get_a(self):
+                return 0.0
+            
+            @setter
+            def set_a(self, value):
+                logged_when_set.append(len(log_tester.logged))
+            
+            @exported_value(type=float, changes='this_setter')
+            def get_b(self):
+                return 0.0
+            
+            @setter
+            def set_b(self, value):
+                logged_when_set.append(len(log_tester.logged))
+        
+        Recorder().state_from_json({u'a': 1, u'b': 'not a number'}, log=log_tester.log)
+        # whichever order the keys are in, the bad value was reported before anything was set
+        self.assertEqual([1], logged_when_set)
+    
+    def test_persistence_side_effect_failure(self):
+        o = BatchSpecimen()
+        o.fail_reconfigure = True
+        log_tester = LogTester()
+        o.state_from_json({u'a': 1}, log=log_tester.log)
+        log_tester.check(dict(text='Discarding erroneous state <BatchSpecimen>.a = 1'))
+        self.assertEqual(1.0, o.get_a())
+    
+    def test_persistence_batched(self):
+        o = BatchSpecimen()
+        st = CellSubscriptionTester(o.state()['a'], interest_tracking=False)
+        o.state_from_json({
+            u'a': 1,
+            u'b': 2,
+            u'block': {u'a': 3, u'b': 4},
+        })
+        # one reconfiguration of each object, after all of its values were set
+        self.assertEqual([(1.0, 2.0)], o.reconfigurations)
+        self.assertEqual([(3.0, 4.0)], o.get_block().reconfigurations)
+        st.expect_now(1.0)
+        
+        # outside of a batch, side effects are immediate
+        o.set_a(5)
+        self.assertEqual([(1.0, 2.0), (5.0, 2.0)], o.reconfigurations)
+    
+    def test_batch_work_failure_propagates(self):
+        calls = []
+        
+        def fail():
+            raise KeyError('boom')
+        
+        def work():
+            calls.append(None)
+        
+        with self.assertRaises(KeyError):
+            with state_batch():
+                after_state_batch(fail)
+                after_state_batch(work)
+        # the rest of the batch is still done
+        self.assertEqual([None], calls)
+        # and the batch is not left open
+        after_state_batch(work)
+        self.assertEqual([None, None], calls)
+    
     def test_persistence_args(self):
         o = unserialize_exported_state(
             ctor=ValueAndBlockSpecimen,
@@ -135,6 +218,46 @@ class ValueAndBlockSpecimen(ExportedState):
         self.__value = value
 
 
+class BatchSpecimen(ExportedState):
+    """Helper for TestExportedState"""
+    def __init__(self, block=None):
+        self.__a = 0.0
+        self.__b = 0.0
+        self.__block = block or BatchSpecimen(block=nullExportedState)
+        self.reconfigurations = []
+        self.fail_reconfigure = False
+    
+    def __repr__(self):
+        return '<BatchSpecimen>'  # no address
+    
+    @exported_value(type=ReferenceT(), changes='never')
+    def get_block(self):
+        return self.__block
+    
+    @exported_value(type=float, changes='this_setter')
+    def get_a(self):
+        return self.__a
+    
+    @setter
+    def set_a(self, value):
+        self.__a = value
+        after_state_batch(self.__reconfigure)
+    
+    @exported_value(type=float, changes='this_setter')
+    def get_b(self):
+        return self.__b
+    
+    @setter
+    def set_b(self, value):
+        self.__b = value
+        after_state_batch(self.__reconfigure)
+    
+    def __reconfigure(self):
+        if self.fail_reconfigure:
+            raise Exception('reconfigure failed')
+        self.reconfigurations.append((self.__a, self.__b))
+
+
 class TestDecoratorInheritance(unittest.TestCase):
     def setUp(self):
         self.object = DecoratorInheritanceSpecimen()
@@ -219,6 +342,73 @@ class TestPollingCell(unittest.TestCase):
     
     # this_setter is handled in TestExportedState because it involves the decorators
     
+    def test_version_getter(self):
+        o = VersionedSpecimen()
+        cell = PollingCell(o, 'value', changes='explicit', version_getter='get_version')
+        st = CellSubscriptionTester(cell, interest_tracking=False)
+        o.value = 1
+        cell.poll_for_change(specific_cell=True)
+        st.expect_now(1)
+        calls = o.get_calls
+        o.value = 2  # without changing the version
+        cell.poll_for_change(specific_cell=True)
+        st.advance()
+        self.assertEqual(calls, o.get_calls)
+        o.version += 1
+        cell.poll_for_change(specific_cell=True)
+        st.expect_now(2)
+    
+    def test_fingerprint(self):
+        o = NoInherentCellSpecimen()
+        cell = PollingCell(o, 'value', changes='explicit', fingerprint=lambda value: value // 10)
+        st = CellSubscriptionTester(cell, interest_tracking=False)
+        o.value = 1
+        cell.poll_for_change(specific_cell=True)
+        st.expect_now(1)
+        o.value = 2  # same fingerprint
+        cell.poll_for_change(specific_cell=True)
+        st.advance()
+        o.value = 10
+        cell.poll_for_change(specific_cell=True)
+        st.expect_now(10)
+    
+    def test_diff(self):
+        o = NoInherentCellSpecimen()
+        o.value = 'a'
+        cell = PollingCell(o, 'value', type=six.text_type, changes='explicit',
+            diff=lambda old, new: new[len(old):] if new.startswith(old) else None)
+        delta_st = CellSubscriptionTester(cell, delta=True, interest_tracking=False)
+        plain_st = CellSubscriptionTester(cell, interest_tracking=False)
+        cell.poll_for_change(specific_cell=True)  # first poll has no old value
+        delta_st.expect_now('a')
+        plain_st.expect_now('a')
+        o.value = 'abc'
+        cell.poll_for_change(specific_cell=True)
+        delta_st.expect_now('bc', kind='append')
+        plain_st.expect_now('abc')
+        o.value = 'x'
+        cell.poll_for_change(specific_cell=True)
+        delta_st.expect_now('x')
+    
+    def test_diff_merged_and_bounded(self):
+        o = NoInherentCellSpecimen()
+        o.value = ''
+        cell = PollingCell(o, 'value', type=six.text_type, changes='explicit')
+        delta_st = CellSubscriptionTester(cell, delta=True, interest_tracking=False)
+        cell.poll_for_change(specific_cell=True)
+        delta_st.expect_now('')
+        # patches within one turn are merged
+        o.value = 'a'
+        cell.poll_for_change(specific_cell=True)
+        o.value = 'ab'
+        cell.poll_for_change(specific_cell=True)
+        delta_st.expect_now('ab', kind='append')
+        # and too many of them are replaced by the current value
+        for _ in six.moves.range(3):
+            o.value += 'x' * 5000
+            cell.poll_for_change(specific_cell=True)
+        delta_st.expect_now(o.value)
+    
     def test_metadata_explicit(self):
         cell = PollingCell(
             target=NoInherentCellSpecimen(),
@@ -260,6 +450,145 @@ class NoInherentCellSpecimen(object):
         return '<NoInherentCellSpecimen repr>'
 
 
+class VersionedSpecimen(NoInherentCellSpecimen):
+    def __init__(self):
+        NoInherentCellSpecimen.__init__(self)
+        self.version = 0
+        self.get_calls = 0
+    
+    def get_value(self):
+        self.get_calls += 1
+        return self.value
+    
+    def get_version(self):
+        return self.version
+
+
+class TestBatchPoller(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.poller = BatchPoller(reactor=self.clock, min_interval=1, max_interval=8)
+        self.context = SubscriptionContext(reactor=self.clock, poller=self.poller)
+        self.object = BatchPollerSpecimen()
+        self.levels = []
+        self.peaks = []
+        self.object.state()['level'].subscribe2(self.levels.append, self.context)
+        self.object.state()['peak'].subscribe2(self.peaks.append, self.context)
+    
+    def test_batch_getter(self):
+        self.object.values = {'level': 1, 'peak': 2}
+        self.object.batch_calls = 0
+        self.clock.advance(1)
+        self.assertEqual(1, self.object.batch_calls)
+        self.assertEqual(0, self.object.single_calls)
+        self.assertEqual(([1], [2]), (self.levels, self.peaks))
+        self.assertEqual(1, self.poller.get_target_count())
+    
+    def test_interval_adapts(self):
+        # unchanging values are polled progressively less often, up to max_interval divided by the 2 subscriptions
+        self.object.batch_calls = 0
+        self.clock.pump([1] * 20)
+        self.assertEqual(6, self.object.batch_calls)
+        
+        # a change is still noticed, and the interval shortens again
+        self.object.values = {'level': 3, 'peak': 3}
+        self.clock.pump([1] * 8)
+        self.assertEqual(([3], [3]), (self.levels, self.peaks))
+        self.object.batch_calls = 0
+        self.object.values = {'level': 4, 'peak': 4}
+        self.clock.pump([1] * 8)
+        self.object.values = {'level': 5, 'peak': 5}
+        self.clock.pump([1] * 8)
+        self.assertEqual(([3, 4, 5], [3, 4, 5]), (self.levels, self.peaks))
+    
+    def test_interval_scales_with_subscriptions(self):
+        self.clock.pump([1] * 20)
+        self.object.batch_calls = 0
+        self.clock.pump([1] * 24)
+        self.assertEqual(6, self.object.batch_calls)
+        
+        self.object.state()['level'].subscribe2(lambda _: None, self.context)
+        self.object.state()['level'].subscribe2(lambda _: None, self.context)
+        self.object.batch_calls = 0
+        self.clock.pump([1] * 24)
+        self.assertEqual(12, self.object.batch_calls)
+    
+    def test_change_resets_interval(self):
+        self.clock.pump([1] * 20)
+        self.object.values = {'level': 3, 'peak': 3}
+        self.clock.pump([1] * 4)
+        self.assertEqual(([3], [3]), (self.levels, self.peaks))
+        # polled again at min_interval
+        self.object.batch_calls = 0
+        self.clock.advance(1)
+        self.assertEqual(1, self.object.batch_calls)
+    
+    def test_getter_failure(self):
+        self.object.values = None  # so the cells' values cannot be found
+        self.clock.advance(1)
+        self.assertEqual(1, len(self.flushLoggedErrors(TypeError)))
+        # polling continues
+        self.object.values = {'level': 6, 'peak': 6}
+        self.clock.pump([1] * 8)
+        self.assertEqual(([6], [6]), (self.levels, self.peaks))
+    
+    def test_unsubscribe(self):
+        cell = self.object.state()['single']
+        seen = []
+        _, subscription = cell.subscribe2(seen.append, self.context)
+        self.object.single = 1
+        self.clock.advance(1)
+        self.assertEqual([1], seen)
+        subscription.unsubscribe()
+        calls = self.object.single_calls
+        self.object.single = 2
+        self.clock.advance(1)
+        self.assertEqual(([1], calls), (seen, self.object.single_calls))
+    
+    def test_no_polling_without_subscribers(self):
+        poller = BatchPoller(reactor=self.clock)
+        _, subscription = self.object.state()['single'].subscribe2(lambda _: None, SubscriptionContext(reactor=self.clock, poller=poller))
+        subscription.unsubscribe()
+        self.assertEqual(0, poller.get_target_count())
+        self.assertEqual([], [call for call in self.clock.getDelayedCalls() if call.active() and call.getTime() < 1])
+    
+    def test_fallback(self):
+        fallback_calls = []
+        
+        class FakePoller(object):
+            def subscribe(self, obj, subscriber, fast=False):
+                fallback_calls.append(obj)
+        
+        poller = BatchPoller(reactor=self.clock, fallback=FakePoller())
+        poller.subscribe(self.object, lambda _: None)
+        self.assertEqual([self.object], fallback_calls)
+
+
+class BatchPollerSpecimen(ExportedState):
+    def __init__(self):
+        self.values = {'level': 0, 'peak': 0}
+        self.single = 0
+        self.batch_calls = 0
+        self.single_calls = 0
+    
+    def get_levels(self):
+        self.batch_calls += 1
+        return self.values
+    
+    @exported_value(type=float, changes='continuous', batch_getter='get_levels')
+    def get_level(self):
+        return self.values['level']
+    
+    @exported_value(type=float, changes='continuous', batch_getter='get_levels')
+    def get_peak(self):
+        return self.values['peak']
+    
+    @exported_value(type=float, changes='continuous')
+    def get_single(self):
+        self.single_calls += 1
+        return self.single
+
+
 # TODO: BlockCell no longer exists, but this test still tests something; rename appropriately
 class TestBlockCell(unittest.TestCase):
     def setUp(self):
@@ -372,6 +701,120 @@ class TestGRSinkCell(unittest.TestCase):
         yield self.inject_bytes(b'ignored')
         st.advance()
     
+    def setUpForClockedBulkData(self, **kwargs):
+        self.clock = _ThreadedClock()
+        self.cell = ElementSinkCell(
+            info_getter=lambda: (0,),
+            type=BulkDataT(array_format='b', info_format='d'),
+            reactor=self.clock,
+            **kwargs)
+        self.dtype = numpy.uint8
+        self.sink = self.cell.create_sink_internal(self.dtype)
+    
+    def test_element_rate_limited(self):
+        self.setUpForClockedBulkData(max_delivery_rate=10)
+        self.sink.work([numpy.frombuffer(b'a', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'b', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        self.assertEqual([e.data for e in self.cell.get()], [b'a', b'b'])
+        self.assertEqual(self.cell.get_coalesced_count(), 1)
+        
+        self.sink.work([numpy.frombuffer(b'c', dtype=self.dtype)], [])
+        self.clock.advance(0.05)
+        self.assertEqual([e.data for e in self.cell.get()], [b'a', b'b'])
+        self.clock.advance(0.05)
+        self.assertEqual([e.data for e in self.cell.get()], [b'a', b'b', b'c'])
+        self.assertEqual(self.cell.get_dropped_count(), 0)
+    
+    def test_element_keep_latest(self):
+        self.setUpForClockedBulkData(max_pending_items=2)
+        self.sink.work([numpy.frombuffer(b'ab', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'cd', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        self.assertEqual([e.data for e in self.cell.get()], [b'c', b'd'])
+        self.assertEqual(self.cell.get_coalesced_count(), 1)
+        self.assertEqual(self.cell.get_dropped_count(), 2)
+    
+    def test_element_get_packed(self):
+        self.setUpForClockedBulkData()
+        self.assertEqual(self.cell.get_packed(), b'')
+        self.sink.work([numpy.frombuffer(b'ab', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'c', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        bulk_type = self.cell.type()
+        self.assertEqual(self.cell.get_packed(), b''.join(bulk_type.pack(element) for element in self.cell.get()))
+    
+    def test_element_keep_latest_partial(self):
+        self.setUpForClockedBulkData(max_pending_items=3)
+        self.sink.work([numpy.frombuffer(b'ab', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'cd', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'ef', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        self.assertEqual([e.data for e in self.cell.get()], [b'd', b'e', b'f'])
+        self.assertEqual(self.cell.get_coalesced_count(), 2)
+        self.assertEqual(self.cell.get_dropped_count(), 3)
+    
+    def test_element_suspend_when_unwatched(self):
+        self.setUpForClockedBulkData(suspend_when_unwatched=True)
+        self.sink.work([numpy.frombuffer(b'a', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        self.assertEqual(self.cell.get(), [])
+        
+        subscription = self.cell.subscribe2(lambda value: None, SubscriptionTester().context)[1]
+        self.sink.work([numpy.frombuffer(b'b', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        self.assertEqual([e.data for e in self.cell.get()], [b'b'])
+        
+        subscription.unsubscribe()
+        self.sink.work([numpy.frombuffer(b'c', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        self.assertEqual([e.data for e in self.cell.get()], [b'b'])
+    
+    def test_string_delta_subscriber_merged(self):
+        self.clock = _ThreadedClock()
+        self.cell = StringSinkCell(
+            encoding='utf-8',
+            history_length=5,
+            reactor=self.clock,
+            interest_tracker=LoopbackInterestTracker())
+        self.dtype = numpy.uint8
+        self.sink = self.cell.create_sink_internal(self.dtype)
+        st = CellSubscriptionTester(self.cell, delta=True)
+        
+        self.sink.work([numpy.frombuffer(b'ab', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'cd', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        st.expect_now('abcd', kind='append')
+        
+        # more than history_length pending, so resynchronized instead
+        self.sink.work([numpy.frombuffer(b'efg', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'hij', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        st.expect_now('fghij', kind='value')
+    
+    def test_string_plain_subscriber_merged(self):
+        self.clock = _ThreadedClock()
+        self.cell = StringSinkCell(
+            encoding='utf-8',
+            history_length=5,
+            reactor=self.clock,
+            interest_tracker=LoopbackInterestTracker())
+        self.dtype = numpy.uint8
+        self.sink = self.cell.create_sink_internal(self.dtype)
+        st = CellSubscriptionTester(self.cell, delta=False)
+        
+        # no patch is lost
+        self.sink.work([numpy.frombuffer(b'ab', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'cd', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        st.expect_now('abcd')
+        
+        # but beyond history_length, the current value is delivered instead
+        self.sink.work([numpy.frombuffer(b'efg', dtype=self.dtype)], [])
+        self.sink.work([numpy.frombuffer(b'hij', dtype=self.dtype)], [])
+        self.clock.advance(0)
+        st.expect_now('fghij')
+    
     @defer.inlineCallbacks
     def test_string_get(self):
         self.setUpForUnicodeString()
@@ -416,6 +859,12 @@ class TestGRSinkCell(unittest.TestCase):
         st.expect_now('deƒ')
 
 
+class _ThreadedClock(Clock):
+    """Helper for TestGRSinkCell: a Clock which also accepts callFromThread."""
+    def callFromThread(self, f, *args, **kwargs):
+        self.callLater(0, f, *args, **kwargs)
+
+
 class TestLooseCell(unittest.TestCase):
     def setUp(self):
         self.lc = LooseCell(
@@ -439,6 +888,13 @@ class TestLooseCell(unittest.TestCase):
         self.lc.set(2)
         st.advance()  # check for unwanted callbacks
     
+    def test_subscription_collapses_values(self):
+        st = CellSubscriptionTester(self.lc)
+        self.lc.set(1)
+        self.lc.set(2)
+        st.expect_now(2)
+        st.advance()  # check that 1 is not delivered later
+    
     def test_repr(self):
         if six.PY2:
             self.assertEqual(repr(self.lc), '<LooseCell PythonT(<type \'int\'>) 0>')
@@ -573,6 +1029,65 @@ class TestStateInsert(unittest.TestCase):
         self.flushLoggedErrors(ValueError)
 
 
+class TestCollectionState(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.context = SubscriptionContext(reactor=self.clock, poller=None)
+        self.table = CellDict(dynamic=True)
+        self.object = CollectionState(self.table)
+    
+    def test_shape_changes_coalesced(self):
+        seen = []
+        self.object.state_subscribe(seen.append, self.context)
+        self.table['a'] = ExportedState()
+        self.table['b'] = ExportedState()
+        del self.table['a']
+        self.assertEqual(seen, [])
+        self.clock.advance(0)
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(['b'], list(seen[0].keys()))
+        self.clock.advance(1)
+        self.assertEqual(len(seen), 1)
+    
+    def test_state_incremental(self):
+        self.table['a'] = ExportedState()
+        state_1 = self.object.state()
+        self.assertIs(state_1, self.object.state())
+        
+        self.table['b'] = ExportedState()
+        state_2 = self.object.state()
+        self.assertEqual(['a'], list(state_1.keys()))  # not mutated
+        self.assertEqual({'a', 'b'}, set(state_2.keys()))
+        
+        del self.table['a']
+        self.assertEqual(['b'], list(self.object.state().keys()))
+    
+    def test_shape_delta(self):
+        self.table['a'] = ExportedState()
+        self.table['b'] = ExportedState()
+        subscriber = _ShapeDeltaSubscriber()
+        self.object.state_subscribe(subscriber, self.context)
+        self.table['c'] = ExportedState()
+        del self.table['a']
+        self.table['d'] = ExportedState()
+        del self.table['d']
+        self.clock.advance(0)
+        self.assertEqual(subscriber.seen, [({'c': self.table.get_cell('c')}, {'a'})])
+
+
+@implementer(IShapeDeltaSubscriber)
+class _ShapeDeltaSubscriber(object):
+    """Helper for TestCollectionState"""
+    def __init__(self):
+        self.seen = []
+    
+    def __call__(self, value):
+        raise Exception('should not be called with a full state')
+    
+    def shape_delta(self, added, removed):
+        self.seen.append((added, removed))
+
+
 class InsertFailSpecimen(CollectionState):
     """Helper for TestStateInsert"""
     def __init__(self):
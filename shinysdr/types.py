@@ -25,7 +25,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import array
 import bisect
-from collections import namedtuple
+from collections import deque, namedtuple
 import math
 import struct
 
@@ -33,6 +33,8 @@ import six
 
 from zope.interface import Interface, implementer
 
+import numpy
+
 from shinysdr.i.json import IJsonSerializable  # reexport
 from shinysdr.i.pycompat import defaultstr
 from shinysdr import units
@@ -92,6 +94,24 @@ class ValueType(object):
         history_length is an integer; the units depend on the type.
         """
         return None
+    
+    def fingerprint(self, value):
+        """Return a value which is cheap to compare and is equal for two values of this type only if they are equal.
+        
+        Used to detect changes in polled cells. The default is the value itself. Equal values may have different fingerprints, at the cost of a redundant notification.
+        """
+        return value
+    
+    def diff(self, old_value, new_value):
+        """Return a patch which, appended to old_value as defined by this type (see create_buffer), gives new_value.
+        
+        Returns None if the type does not support patches or the difference is not worth expressing as one, in which case the whole new value is used.
+        """
+        return None
+    
+    def merge_patches(self, older, newer):
+        """Return a single patch equivalent to appending the patch older and then newer, or None if they cannot be merged."""
+        return None
 
 
 __all__.append('ValueType')
@@ -106,6 +126,9 @@ class IDeltaBuffer(Interface):
     def __call__(value):
         """Replace the current value."""
     
+    def clear():
+        """Replace the current value with an empty value."""
+    
     def append(patch):
         """Append to the current value."""
     
@@ -141,6 +164,21 @@ class PythonT(ValueType):
             return _StringDeltaBuffer(self.__python_type(), history_length=history_length)
         else:
             return None
+    
+    def diff(self, old_value, new_value):
+        # Strings which only grow, such as logs, are sent as the new text alone, matching create_buffer's append.
+        if (issubclass(self.__python_type, (bytes, six.text_type)) and
+                isinstance(old_value, self.__python_type) and
+                isinstance(new_value, self.__python_type) and
+                len(new_value) > len(old_value) and
+                new_value.startswith(old_value)):
+            return new_value[len(old_value):]
+        return None
+    
+    def merge_patches(self, older, newer):
+        if isinstance(older, (bytes, six.text_type)) and type(older) == type(newer):  # pylint: disable=unidiomatic-typecheck
+            return older + newer
+        return None
 
 
 # TODO: Replace this raw object with a proper API
@@ -157,30 +195,86 @@ __all__.append('python_type_registry')
 
 
 @implementer(IDeltaBuffer)
-class _StringDeltaBuffer(object):
+class _ChunkedDeltaBuffer(object):
+    """Holds the last history_length items of a sequence value as a sequence of the patches (chunks) it was built from, which are joined only when the value is requested, so that appending costs nothing per item."""
     def __init__(self, value, history_length):
         self.__history_length = history_length
-        self.__value = value
+        self.__chunks = deque()
+        self.__head_offset = 0  # number of items at the start of __chunks[0] which have been discarded
+        self.__length = 0  # excluding __head_offset
+        self.__value = None  # cached join of __chunks, or None if stale
         self.__is_truncated = False
+        self(value)
+    
+    def _join(self, chunks):
+        """Implement this method to concatenate a list of chunks, which may be empty."""
+        raise NotImplementedError(self)
     
     def get(self):
+        # The returned value is shared by all callers until the next mutation, and so must not be mutated.
+        if self.__value is None:
+            chunks = self.__chunks
+            if self.__head_offset:
+                chunks[0] = chunks[0][self.__head_offset:]
+                self.__head_offset = 0
+            value = self.__value = self._join(list(chunks))
+            # Replace the chunks with the joined value so later joins are not repeated work.
+            self.__chunks = deque([value]) if len(value) else deque()
         return self.__value
-
+    
     def __call__(self, value):
         self.__is_truncated = False
-        self.__truncate_and_update(value)
+        self.__chunks = deque([value]) if len(value) else deque()
+        self.__head_offset = 0
+        self.__length = len(value)
+        self.__value = None
+        self.__truncate()
+    
+    def clear(self):
+        self.__is_truncated = False
+        self.__chunks = deque()
+        self.__head_offset = 0
+        self.__length = 0
+        self.__value = None
     
     def append(self, patch):
-        self.__truncate_and_update(self.__value + patch)
+        if not len(patch):
+            return
+        self.__chunks.append(patch)
+        self.__length += len(patch)
+        self.__value = None
+        self.__truncate()
     
     def prepend(self, patch):
-        if self.__is_truncated:
+        if self.__is_truncated or not len(patch):
+            return
+        # not truncated, so __head_offset is zero
+        self.__chunks.appendleft(patch)
+        self.__length += len(patch)
+        self.__value = None
+        self.__truncate()
+    
+    def __truncate(self):
+        excess = self.__length - self.__history_length
+        if excess <= 0:
             return
-        self.__truncate_and_update(patch + self.__value)
+        self.__is_truncated = True
+        self.__length -= excess
+        chunks = self.__chunks
+        # Discard whole chunks, then only advance the offset into the first remaining one, so that no items are copied here.
+        while chunks and excess >= len(chunks[0]) - self.__head_offset:
+            excess -= len(chunks.popleft()) - self.__head_offset
+            self.__head_offset = 0
+        self.__head_offset += excess
+
+
+class _StringDeltaBuffer(_ChunkedDeltaBuffer):
+    def __init__(self, value, history_length):
+        self.__empty = value[:0]  # of the appropriate string type
+        super(_StringDeltaBuffer, self).__init__(value, history_length)
     
-    def __truncate_and_update(self, untruncated):
-        self.__value = untruncated[-self.__history_length:]
-        self.__is_truncated = self.__is_truncated or len(untruncated) > self.__history_length
+    def _join(self, chunks):
+        return self.__empty.join(chunks)
 
 
 class ConstantT(ValueType):
@@ -532,6 +626,93 @@ class BulkDataElement(namedtuple('BulkDataElement', [
 __all__.append('BulkDataElement')
 
 
+@implementer(IJsonSerializable)
+class BulkDataBlock(object):
+    """A sequence of BulkDataElements which share the same info and whose data are the rows of one NumPy array.
+    
+    This allows a batch of elements to be produced and serialized without creating a Python object per element; elements are only created when they are individually accessed.
+    
+    The array must not be mutated after being given to this object.
+    """
+    def __init__(self, info, array):
+        self.info = info
+        self.__array = array
+    
+    def __len__(self):
+        return len(self.__array)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # NumPy slices are views, so this does not copy.
+            return BulkDataBlock(self.info, self.__array[index])
+        return BulkDataElement(info=self.info, data=self.__array[index].tobytes())
+    
+    def __iter__(self):
+        info = self.info
+        for row in self.__array:
+            yield BulkDataElement(info=info, data=row.tobytes())
+    
+    def __eq__(self, other):
+        if isinstance(other, BulkDataBlock):
+            # compare the arrays directly rather than creating an element per row
+            return self is other or (
+                self.info == other.info and
+                self.__array.dtype == other.__array.dtype and
+                self.__array.shape == other.__array.shape and
+                numpy.array_equal(self.__array, other.__array))
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return False
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return '{0}(info={1!r}, {2} elements)'.format(type(self).__name__, self.info, len(self))
+    
+    def to_json(self):
+        return list(self)
+    
+    def concatenate(self, other):
+        """Return a BulkDataBlock of the elements of self followed by those of other, or None if other is not a BulkDataBlock with the same info and row shape."""
+        return BulkDataBlock.concatenate_all([self, other])
+    
+    @staticmethod
+    def concatenate_all(blocks):
+        """Return a BulkDataBlock of the elements of all of blocks in order, copying each array once, or None if they are not all BulkDataBlocks with the same info and row shape."""
+        if not blocks or not all(isinstance(block, BulkDataBlock) for block in blocks):
+            return None
+        first = blocks[0]
+        if len(blocks) == 1:
+            return first
+        row_shape = first.__array.shape[1:]
+        for block in blocks:
+            if block.info != first.info or block.__array.shape[1:] != row_shape:
+                return None
+        return BulkDataBlock(first.info, numpy.concatenate([block.__array for block in blocks]))
+    
+    def _get_array(self):
+        """For _BulkDataDeltaBuffer."""
+        return self.__array
+    
+    def pack_rows(self, info_format):
+        """Return the concatenation of BulkDataT.pack() of each element."""
+        array = numpy.ascontiguousarray(self.__array)
+        count = len(array)
+        header = numpy.frombuffer(struct.pack(info_format, *self.info), dtype=numpy.uint8)
+        rows = array.view(numpy.uint8).reshape(count, -1) if count else numpy.empty((0, 0), dtype=numpy.uint8)
+        packed = numpy.empty((count, len(header) + rows.shape[1]), dtype=numpy.uint8)
+        packed[:, :len(header)] = header
+        packed[:, len(header):] = rows
+        return packed.tobytes()
+
+
+__all__.append('BulkDataBlock')
+
+
 class BulkDataT(ValueType):
     """Type for arrays of BulkDataElement objects which, particularly, are delivered to the client in efficient binary form rather than JSON."""
     def __init__(self, info_format, array_format):
@@ -555,9 +736,21 @@ class BulkDataT(ValueType):
     def pack(self, value):
         return struct.pack(self.get_info_format(), *value.info) + value.data
     
+    def pack_many(self, values):
+        """Return the concatenation of pack() of each of the values, which may be a list of BulkDataElement or a BulkDataBlock."""
+        if isinstance(values, BulkDataBlock):
+            return values.pack_rows(self.get_info_format())
+        return b''.join(self.pack(value) for value in values)
+    
     def __call__(self, specimen):
         raise Exception('Coerce not implemented for BulkDataT')
     
+    def fingerprint(self, value):
+        if isinstance(value, BulkDataBlock):
+            # Blocks are immutable, so a getter returning the same block has not changed, and comparing contents would cost as much as the data. The poller keeps the previous value, so its id cannot have been reused.
+            return id(value)
+        return value
+    
     # TODO implement coerce behavior, generally make this more well-defined
     
     def create_buffer(self, history_length):
@@ -569,29 +762,152 @@ __all__.append('BulkDataT')
 
 @implementer(IDeltaBuffer)
 class _BulkDataDeltaBuffer(object):
+    """Holds the most recent history_length elements as rows of a preallocated NumPy array, so that appending costs only the size of the patch and get() returns a view of the array rather than a copy.
+    
+    The array has room for twice history_length rows. Rows are only ever written to positions after the newest one, and when the array is full the retained rows are copied into a new array, so the views returned by get() are never mutated and the copying costs a constant amount per appended row.
+    
+    The value is a BulkDataBlock if all of the retained elements share the same info, and otherwise a list of BulkDataElements. Elements whose data does not have the same size and type as the previous ones replace the history rather than being mixed with it.
+    """
     def __init__(self, history_length):
-        self.__history_length = history_length
-        self.__items = []
+        self.__capacity = history_length
+        self.__array = None  # allocated once the row shape is known
+        self.__end = 0  # index in __array after the newest row
+        self.__count = 0
+        self.__info_runs = deque()  # [index in __array, info] of the first row of each run of rows sharing an info
+        self.__value = []  # cached result of get(), or None if stale
         self.__is_truncated = False
     
     def get(self):
-        return self.__items[:]  # make copy of list that is mutated
-
+        if self.__value is None:
+            self.__value = self.__make_value()
+        return self.__value
+    
     def __call__(self, value):
         self.__is_truncated = False
-        self.__items = value[:]
+        self.__discard()
+        self.__append_patch(value)
+    
+    def clear(self):
+        self.__is_truncated = False
+        self.__discard()
     
     def append(self, patch):
-        self.__items.extend(patch)
-        self.__truncate_and_update()
+        self.__append_patch(patch)
     
     def prepend(self, patch):
-        if self.__is_truncated:
+        if self.__is_truncated or not len(patch):
             return
-        self.__items[:0] = patch
-        self.__truncate_and_update()
-    
-    def __truncate_and_update(self):
-        if len(self.__items) > self.__history_length:
-            self.__items[:-self.__history_length] = []
+        old_value = self.get()
+        self.__discard()
+        self.__append_patch(patch)
+        self.__append_patch(old_value)
+    
+    def __discard(self):
+        self.__array = None
+        self.__end = 0
+        self.__count = 0
+        self.__info_runs.clear()
+        self.__value = []
+    
+    def __append_patch(self, patch):
+        if isinstance(patch, BulkDataBlock):
+            self.__append_rows(patch.info, patch._get_array())
+            return
+        # a list of elements; convert each run of elements with the same info and size to rows
+        run = []
+        for element in patch:
+            if run and (element.info != run[0].info or len(element.data) != len(run[0].data)):
+                self.__append_elements(run)
+                run = []
+            run.append(element)
+        if run:
+            self.__append_elements(run)
+    
+    def __append_elements(self, elements):
+        rows = numpy.frombuffer(b''.join(element.data for element in elements), dtype=numpy.uint8)
+        self.__append_rows(elements[0].info, rows.reshape(len(elements), len(elements[0].data)))
+    
+    def __append_rows(self, info, rows):
+        capacity = self.__capacity
+        patch_length = len(rows)
+        if patch_length == 0 or capacity == 0:
+            return
+        rows = self.__fit(rows)
+        count = self.__count
+        if patch_length >= capacity:
+            self.__is_truncated = self.__is_truncated or count + patch_length > capacity
+            self.__discard()
+            self.__allocate(rows)
+            rows = rows[-capacity:]
+            patch_length = capacity
+            count = 0
+        elif self.__end + patch_length > len(self.__array):
+            self.__compact(capacity - patch_length)
+        array = self.__array
+        end = self.__end
+        array[end:end + patch_length] = rows
+        info_runs = self.__info_runs
+        if not info_runs or info_runs[-1][1] != info:
+            info_runs.append([end, info])
+        end = self.__end = end + patch_length
+        if count + patch_length > capacity:
+            self.__is_truncated = True
+            count = capacity
+        else:
+            count += patch_length
+        self.__count = count
+        while len(info_runs) > 1 and info_runs[1][0] <= end - count:
+            info_runs.popleft()
+        self.__value = None
+    
+    def __fit(self, rows):
+        """Return rows in the form of the rows of __array, allocating it (and discarding any history) if they are not compatible."""
+        array = self.__array
+        if array is not None:
+            if rows.dtype == array.dtype and rows.shape[1:] == array.shape[1:]:
+                return rows
+            row_size = array.itemsize * int(numpy.prod(array.shape[1:]))
+            if rows.dtype == numpy.uint8 and rows.ndim == 2 and rows.shape[1] == row_size:
+                # data of elements, to be reinterpreted
+                return rows.view(array.dtype).reshape((len(rows),) + array.shape[1:])
+            self.__is_truncated = self.__is_truncated or self.__count > 0
+            self.__discard()
+        self.__allocate(rows)
+        return rows
+    
+    def __allocate(self, rows):
+        self.__array = numpy.empty((2 * self.__capacity,) + rows.shape[1:], dtype=rows.dtype)
+        self.__end = 0
+    
+    def __compact(self, keep):
+        """Move the newest keep rows to the start of a new array. A new array is used so that values previously returned from get() remain unchanged."""
+        if keep < self.__count:
             self.__is_truncated = True
+        keep = min(keep, self.__count)
+        old_array = self.__array
+        start = self.__end - keep
+        array = self.__array = numpy.empty_like(old_array)
+        array[:keep] = old_array[start:self.__end]
+        self.__end = keep
+        self.__count = keep
+        info_runs = self.__info_runs
+        while len(info_runs) > 1 and info_runs[1][0] <= start:
+            info_runs.popleft()
+        for run in info_runs:
+            run[0] = max(0, run[0] - start)
+    
+    def __make_value(self):
+        if self.__count == 0:
+            return []
+        array = self.__array
+        end = self.__end
+        start = end - self.__count
+        info_runs = self.__info_runs
+        if len(info_runs) == 1:
+            return BulkDataBlock(info_runs[0][1], array[start:end])
+        # differing info, so cannot share a block
+        elements = []
+        for i, (run_start, info) in enumerate(info_runs):
+            run_end = info_runs[i + 1][0] if i + 1 < len(info_runs) else end
+            elements.extend(BulkDataBlock(info, array[max(start, run_start):run_end]))
+        return elements
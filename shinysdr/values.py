@@ -23,7 +23,10 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import codecs
-from collections import namedtuple
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+import sys
+import threading
 import weakref
 
 import six
@@ -36,7 +39,7 @@ from zope.interface import Interface, implementer  # available via Twisted
 from gnuradio import gr
 import numpy
 
-from shinysdr.types import BulkDataElement, BulkDataT, EnumRow, ReferenceT, to_value_type
+from shinysdr.types import BulkDataBlock, BulkDataT, EnumRow, ReferenceT, to_value_type
 
 
 _log = Logger()
@@ -111,6 +114,20 @@ class IDeltaSubscriber(ISubscriber):
         """
 
 
+class IShapeDeltaSubscriber(ISubscriber):
+    """Interface for subscribing to the shape of an ExportedState and being told only what changed, when that is known.
+    
+    Subscribers which do not provide this interface are always called with the entire new state().
+    """
+    
+    def shape_delta(added, removed):
+        """Be notified of a change in the cells of the object.
+        
+        added: dict of key to cell, for cells which were added or replaced.
+        removed: set of keys of cells which were removed or replaced. Removals should be applied before additions.
+        """
+
+
 class InterestTracker(object):
     """Collects expressions of interest in some cells' values to track whether there currently are any."""
     
@@ -281,9 +298,21 @@ _cell_value_change_schedules = [
 ]
 
 
+# Placeholder for the last polled value, fingerprint, or version of a cell which has not yet been polled.
+_NOT_POLLED = object()
+
+# The number of items of patches which may be queued for one subscription to a PollingCell before the subscriber is instead given the whole current value.
+_POLLED_MAX_PENDING_LENGTH = 10000
+
+# Placeholder for a patch which has not yet been computed, as distinct from None meaning that there is no patch.
+_NO_PATCH = object()
+
+
 class PollingCell(TargetingMixin, ValueCell):
     __explicit_subscriptions = None
-    __last_polled_value = None
+    __last_polled_value = _NOT_POLLED
+    __last_polled_fingerprint = _NOT_POLLED
+    __last_polled_version = _NOT_POLLED
     __setter = None
     
     def __init__(self,
@@ -294,7 +323,20 @@ class PollingCell(TargetingMixin, ValueCell):
             writable=False,
             persists=None,
             interest_tracker=nullInterestTracker,
+            batch_getter=None,
+            version_getter=None,
+            fingerprint=None,
+            diff=None,
             **kwargs):
+        """
+        batch_getter: optional name of a method of target which returns a dict containing this cell's value, under its key, along with the values of other cells of the same target. A BatchPoller uses it to fetch all such values with one call; it has no effect otherwise.
+        
+        version_getter: optional name of a method of target which returns a value (such as a counter) that changes whenever this cell's value may have changed. While it is unchanged, polling does not call the getter.
+        
+        fingerprint: optional function from a value to something cheaper to compare, used to detect changes; defaults to the type's fingerprint method.
+        
+        diff: optional function (old_value, new_value) returning a patch to deliver to IDeltaSubscribers instead of the whole new value, or None; defaults to the type's diff method. The getter must not return objects which are later mutated, or the old value will be wrong.
+        """
         assert changes in _cell_value_change_schedules
         type = to_value_type(type)
         if persists is None:
@@ -320,11 +362,33 @@ class PollingCell(TargetingMixin, ValueCell):
         self.__changes = changes
         if changes == u'explicit' or changes == u'this_setter':
             self.__explicit_subscriptions = set()
-            self.__last_polled_value = object()
         
         self.__getter = getattr(self._target, 'get_' + key)
         if writable:
             self.__setter = getattr(self._target, 'set_' + key)
+        if batch_getter is not None:
+            # early error for debugging
+            getattr(self._target, batch_getter)
+        self.__batch_getter = batch_getter
+        self.__version_getter = getattr(self._target, version_getter) if version_getter is not None else None
+        self.__fingerprint = fingerprint or type.fingerprint
+        self.__diff = diff or type.diff
+    
+    def _batch_getter_name(self):
+        """For BatchPoller."""
+        return self.__batch_getter
+    
+    def _version(self):
+        """Return the current version, or _NOT_POLLED if there is no version getter and so the value must always be checked."""
+        if self.__version_getter is None:
+            return _NOT_POLLED
+        return self.__version_getter()
+    
+    def _fingerprint(self, value):
+        return self.__fingerprint(value)
+    
+    def _diff(self, old_value, new_value):
+        return self.__diff(old_value, new_value)
     
     def get(self):
         value = self.__getter()
@@ -345,7 +409,11 @@ class PollingCell(TargetingMixin, ValueCell):
         elif changes == u'continuous':
             subscription = context.poller.subscribe(self, subscriber, fast=True)
         elif changes == u'explicit' or changes == u'this_setter':
-            subscription = _SimpleSubscription(subscriber, context, self.__explicit_subscriptions, self.interest_tracker)
+            subscription = _SimpleSubscription(subscriber, context, self.__explicit_subscriptions, self.interest_tracker,
+                # bounds the patches from diff() queued for a slow subscriber
+                resync_getter=self.get,
+                max_pending_length=_POLLED_MAX_PENDING_LENGTH,
+                patch_merger=self.type().merge_patches)
         else:
             raise ValueError('shouldn\'t happen unrecognized changes value: {!r}'.format(changes))
         return self.get(), subscription
@@ -354,22 +422,225 @@ class PollingCell(TargetingMixin, ValueCell):
         if self.__explicit_subscriptions is None:
             # Note that this is "we are not a kind of cell that has explicit subscriptions", not "we have no subscriptions". Doing the latter would mean that a new subscription might fire after subscribing not because the value actually changed but only because poll_for_changed was called.
             return
+        version = self._version()
+        if version is not _NOT_POLLED and version == self.__last_polled_version:
+            return
+        self.__last_polled_version = version
         value = self.get()
-        if value != self.__last_polled_value:
+        fingerprint = self.__fingerprint(value)
+        if fingerprint != self.__last_polled_fingerprint:
+            old_value = self.__last_polled_value
             self.__last_polled_value = value
-            for subscription in self.__explicit_subscriptions:
-                subscription._fire(value)
+            self.__last_polled_fingerprint = fingerprint
+            _notify_polled_change(self, self.__explicit_subscriptions, old_value, value)
     
     def poll_for_change_from_setter(self):
         if self.__changes == u'this_setter':
             self.poll_for_change(specific_cell=True)
 
 
+def _notify_polled_change(cell, subscriptions, old_value, new_value):
+    """Deliver a changed value of a PollingCell, as a patch to subscriptions which want one and it can be computed."""
+    patch = _NO_PATCH
+    for subscription in subscriptions:
+        if old_value is not _NOT_POLLED and subscription._wants_delta():
+            if patch is _NO_PATCH:
+                patch = cell._diff(old_value, new_value)
+            if patch is not None:
+                subscription._fire_append(patch)
+                continue
+        subscription._fire(new_value)
+
+
+class BatchPoller(object):
+    """Polls the values of continuously-changing PollingCells, grouped by the object they belong to.
+    
+    All subscribed cells of one target object are polled together, and cells which share a batch_getter are fetched with a single call to it. Each target is polled at its own interval, which returns to min_interval seconds as soon as its values are seen to change and is lengthened while they are not. The longest interval is max_interval divided by the number of subscriptions to the target's cells, so that values more clients are watching are kept more current. Targets without subscriptions are not polled at all.
+    
+    Subscriptions to anything other than a PollingCell are passed to fallback (such as a shinysdr.i.poller.Poller), so that a BatchPoller may be used as the poller of a SubscriptionContext.
+    """
+    def __init__(self, reactor=the_reactor, fallback=None, min_interval=1 / 30, max_interval=0.25):
+        self.__reactor = reactor
+        self.__fallback = fallback
+        self.__min_interval = min_interval
+        self.__max_interval = max_interval
+        self.__targets = {}  # target object -> _BatchPollerTarget
+        self.__tick_call = None
+    
+    def subscribe(self, cell, subscriber, fast=False):
+        if not isinstance(cell, PollingCell):
+            if self.__fallback is None:
+                raise TypeError('BatchPoller cannot poll {!r} and has no fallback'.format(cell))
+            return self.__fallback.subscribe(cell, subscriber, fast=fast)
+        target = self.__targets.get(cell._target)
+        if target is None:
+            target = self.__targets[cell._target] = _BatchPollerTarget(
+                cell._target,
+                interval=self.__min_interval,
+                next_time=self.__reactor.seconds() + self.__min_interval)
+        subscription = _BatchPollerSubscription(self, target.get_entry(cell), subscriber)
+        self.__schedule()
+        return subscription
+    
+    def poll_all(self):
+        """Poll every subscribed cell now, regardless of schedule."""
+        for target in list(six.itervalues(self.__targets)):
+            target.poll()
+        if self.__fallback is not None:
+            self.__fallback.poll_all()
+    
+    def get_target_count(self):
+        """Return the number of objects currently being polled."""
+        return len(self.__targets)
+    
+    def _unsubscribed(self, entry):
+        """Called by _BatchPollerSubscription."""
+        target = self.__targets.get(entry.cell._target)
+        if target is None or not target.remove_entry_if_unused(entry):
+            return
+        del self.__targets[entry.cell._target]
+        if not self.__targets and self.__tick_call is not None:
+            self.__tick_call.cancel()
+            self.__tick_call = None
+    
+    def __tick(self):
+        self.__tick_call = None
+        now = self.__reactor.seconds()
+        for target in list(six.itervalues(self.__targets)):
+            if target.next_time > now:
+                continue
+            longest = max(self.__min_interval, self.__max_interval / max(1, target.get_subscription_count()))
+            try:
+                changed = target.poll()
+            except Exception:  # pylint: disable=broad-except
+                # A broken getter must not stop the polling of other targets; try it again only as often as an unchanging one.
+                _log.failure('Error polling {target}', target=target)
+                target.interval = longest
+            else:
+                if changed:
+                    target.interval = self.__min_interval
+                else:
+                    target.interval = min(longest, target.interval * 1.5)
+            target.next_time = now + target.interval
+        self.__schedule()
+    
+    def __schedule(self):
+        if not self.__targets:
+            return
+        due = min(target.next_time for target in six.itervalues(self.__targets))
+        if self.__tick_call is not None:
+            if self.__tick_call.getTime() <= due:
+                return
+            self.__tick_call.cancel()
+        self.__tick_call = self.__reactor.callLater(max(0, due - self.__reactor.seconds()), self.__tick)
+
+
+class _BatchPollerTarget(object):
+    """All the polled cells of one target object."""
+    def __init__(self, target, interval, next_time):
+        self.__target = target
+        self.__entries = {}  # key -> _BatchPollerEntry
+        self.interval = interval
+        self.next_time = next_time
+    
+    def get_entry(self, cell):
+        entry = self.__entries.get(cell.key())
+        if entry is None:
+            entry = self.__entries[cell.key()] = _BatchPollerEntry(cell)
+        return entry
+    
+    def get_subscription_count(self):
+        return sum(len(entry.subscriptions) for entry in six.itervalues(self.__entries))
+    
+    def remove_entry_if_unused(self, entry):
+        """Returns whether this target no longer has any entries."""
+        if not entry.subscriptions:
+            self.__entries.pop(entry.cell.key(), None)
+        return not self.__entries
+    
+    def poll(self):
+        """Poll all cells, notify subscribers, and return whether any value changed."""
+        batches = {}
+        changed = False
+        for key, entry in list(six.iteritems(self.__entries)):
+            if not entry.version_changed():
+                continue
+            batch_getter_name = entry.cell._batch_getter_name()
+            if batch_getter_name is None:
+                value = entry.cell.get()
+            else:
+                batch = batches.get(batch_getter_name)
+                if batch is None:
+                    batch = batches[batch_getter_name] = getattr(self.__target, batch_getter_name)()
+                value = batch[key]
+            if entry.update(value):
+                changed = True
+        return changed
+
+
+class _BatchPollerEntry(object):
+    """One polled cell and its subscriptions."""
+    def __init__(self, cell):
+        self.cell = cell
+        self.subscriptions = set()
+        self.__last_version = cell._version()
+        self.__last_value = cell.get()
+        self.__last_fingerprint = cell._fingerprint(self.__last_value)
+    
+    def version_changed(self):
+        version = self.cell._version()
+        if version is not _NOT_POLLED and version == self.__last_version:
+            return False
+        self.__last_version = version
+        return True
+    
+    def update(self, value):
+        fingerprint = self.cell._fingerprint(value)
+        if fingerprint == self.__last_fingerprint:
+            return False
+        old_value = self.__last_value
+        self.__last_value = value
+        self.__last_fingerprint = fingerprint
+        _notify_polled_change(self.cell, list(self.subscriptions), old_value, value)
+        return True
+
+
+@implementer(ISubscription)
+class _BatchPollerSubscription(object):
+    def __init__(self, poller, entry, subscriber):
+        self.__poller = poller
+        self.__entry = entry
+        self.__subscriber = subscriber
+        self._fire = subscriber
+        self.__interest_token = object()
+        entry.cell.interest_tracker.set(self.__interest_token, True)
+        entry.subscriptions.add(self)
+    
+    def _wants_delta(self):
+        return IDeltaSubscriber.providedBy(self.__subscriber)
+    
+    def _fire_append(self, patch):
+        self.__subscriber.append(patch)
+    
+    def unsubscribe(self):
+        entry = self.__entry
+        entry.subscriptions.remove(self)
+        entry.cell.interest_tracker.set(self.__interest_token, False)
+        self.__poller._unsubscribed(entry)
+    
+    def __repr__(self):
+        return u'<{} calling {}>'.format(type(self).__name__, self.__subscriber)
+
+
 class GRSinkCell(ValueCell):
     """A cell whose streaming value is the items collected by a gnuradio sink.
     
     Note that the info getter is called from a GNU Radio thread.
     
+    By default, each work() call of the sink is delivered to the reactor separately. If max_delivery_rate (per second) or max_pending_items is given, then patches are instead merged in the GNU Radio thread while a delivery is pending, and delivered at most max_delivery_rate times per second; if more than max_pending_items items are pending, the oldest ones are dropped.
+    
+    If suspend_when_unwatched is true, then while the cell has no subscribers its sink discards its input without copying or processing it, and the history is discarded when a subscriber next arrives. This is appropriate for values, such as spectrum displays, which are not interesting except as they are watched. (To also stop the upstream computation, the owner should use the interest_tracker.)
+    
     Abstract; use ElementSinkCell or StringSinkCell directly.
     """
     
@@ -378,6 +649,9 @@ class GRSinkCell(ValueCell):
             history_length,
             reactor=the_reactor,  # default because most uses will be from GR
             info_getter=lambda: None,
+            max_delivery_rate=None,
+            max_pending_items=None,
+            suspend_when_unwatched=False,
             **kwargs):
         type = to_value_type(type)
         if not (type == to_value_type(six.text_type) or isinstance(type, BulkDataT)):
@@ -391,10 +665,22 @@ class GRSinkCell(ValueCell):
         self.__buffer = type.create_buffer(history_length)
         if not self.__buffer:
             raise ValueError('Type {} does not support patch buffers'.format(type))
+        self.__history_length = history_length
         
         self.__subscriptions = set()
         self.__info_getter = info_getter
         self.__reactor = reactor
+        self.__suspend_when_unwatched = suspend_when_unwatched
+        
+        self.__max_delivery_rate = max_delivery_rate
+        self.__max_pending_items = max_pending_items
+        self.__pending_lock = threading.Lock()
+        self.__pending_patches = deque()  # joined only when delivered, so that each item is copied once
+        self.__pending_length = 0
+        self.__delivery_scheduled = False
+        self.__last_delivery_time = None
+        self.__coalesced_count = 0
+        self.__dropped_count = 0
     
     def create_sink_internal(self, numpy_type):
         """Create a sink which feeds into this cell.
@@ -412,16 +698,80 @@ class GRSinkCell(ValueCell):
     
     def subscribe2(self, subscriber, context):
         """implement abstract"""
-        return self.get(), _SimpleSubscription(subscriber, context, self.__subscriptions, self.interest_tracker)
+        if self.__suspend_when_unwatched and not self.__subscriptions:
+            # Whatever we have is from before we were suspended, so out of date.
+            self.__buffer.clear()
+        return self.get(), _SimpleSubscription(subscriber, context, self.__subscriptions, self.interest_tracker,
+            # A subscriber more than a history's worth behind would not see anything the current value doesn't contain.
+            resync_getter=self.get,
+            max_pending_length=self.__history_length,
+            patch_merger=lambda older, newer: self._join_patches([older, newer]))
+    
+    def get_coalesced_count(self):
+        """Return the number of patches which were merged into a previous patch rather than delivered separately."""
+        return self.__coalesced_count
+    
+    def get_dropped_count(self):
+        """Return the number of items which were discarded because more than max_pending_items were pending."""
+        return self.__dropped_count
+    
+    def _is_suspended(self):
+        """Whether the sink should discard its input. Called from the GNU Radio thread."""
+        return self.__suspend_when_unwatched and not self.__subscriptions
     
     def _transform_in_thread(self, info, array):
         """Implement this method to convert the numpy array to a patch suitable for the value type."""
         raise NotImplementedError(self)
     
+    def _join_patches(self, patches):
+        """Implement this method to concatenate a nonempty list of patches. It may be called from any thread."""
+        raise NotImplementedError(self)
+    
     def _process_from_work_thread(self, array):
         info = self.__info_getter()
         patch = self._transform_in_thread(info, array)
-        self.__reactor.callFromThread(self.__deliver, patch)
+        if self.__max_delivery_rate is None and self.__max_pending_items is None:
+            self.__reactor.callFromThread(self.__deliver, patch)
+            return
+        
+        with self.__pending_lock:
+            pending = self.__pending_patches
+            if pending:
+                self.__coalesced_count += 1
+            pending.append(patch)
+            self.__pending_length += len(patch)
+            limit = self.__max_pending_items
+            if limit is not None and self.__pending_length > limit:
+                self.__drop_pending(self.__pending_length - limit)
+            if self.__delivery_scheduled:
+                return
+            self.__delivery_scheduled = True
+        self.__reactor.callFromThread(self.__deliver_pending)
+    
+    def __drop_pending(self, count):
+        """Discard the oldest count pending items. Called with the pending lock held."""
+        pending = self.__pending_patches
+        self.__dropped_count += count
+        self.__pending_length -= count
+        while count > 0 and count >= len(pending[0]):
+            count -= len(pending.popleft())
+        if count > 0:
+            pending[0] = pending[0][count:]
+    
+    def __deliver_pending(self):
+        rate = self.__max_delivery_rate
+        if rate is not None and self.__last_delivery_time is not None:
+            delay = self.__last_delivery_time + 1.0 / rate - self.__reactor.seconds()
+            if delay > 0:
+                self.__reactor.callLater(delay, self.__deliver_pending)
+                return
+        with self.__pending_lock:
+            patches = list(self.__pending_patches)
+            self.__pending_patches.clear()
+            self.__pending_length = 0
+            self.__delivery_scheduled = False
+        self.__last_delivery_time = self.__reactor.seconds()
+        self.__deliver(self._join_patches(patches))
     
     def __deliver(self, patch):
         self.__buffer.append(patch)
@@ -438,6 +788,8 @@ class _StreamBackingSink(gr.sync_block):
         self.__cell = cell
 
     def work(self, input_items, output_items):
+        if self.__cell._is_suspended():
+            return len(input_items[0])
         items_numpy_array = input_items[0].copy()
         self.__cell._process_from_work_thread(items_numpy_array)
         return len(items_numpy_array)
@@ -454,13 +806,20 @@ class ElementSinkCell(GRSinkCell):
             history_length=history_length,
             **kwargs)
     
+    def get_packed(self):
+        """Return the current value in the binary form given by BulkDataT.pack_many, which for the usual case of elements sharing one info is produced without creating an object per element."""
+        return self.type().pack_many(self.get())
+    
     def _transform_in_thread(self, info, array):
-        # Extract single items (vectors) and attach info.
-        parsed_items = []
-        for item in array:
-            parsed_items.append(BulkDataElement(data=item.tobytes(), info=info))
-        
-        return parsed_items
+        # The array is already a copy owned by us, so the items (vectors) can share it as their data.
+        return BulkDataBlock(info=info, array=array)
+    
+    def _join_patches(self, patches):
+        joined = BulkDataBlock.concatenate_all(patches)
+        if joined is not None:
+            return joined
+        # differing info, so cannot share a block
+        return [element for patch in patches for element in patch]
 
 
 class StringSinkCell(GRSinkCell):
@@ -480,6 +839,9 @@ class StringSinkCell(GRSinkCell):
     
     def _transform_in_thread(self, info, array):
         return self.__decoder.decode(array.tobytes())
+    
+    def _join_patches(self, patches):
+        return ''.join(patches)
 
 
 class LooseCell(ValueCell):
@@ -540,31 +902,105 @@ class LooseCell(ValueCell):
         return subscription
 
 
+# Placeholder in _SimpleSubscription's queue for "the current value, whatever it is at delivery time".
+_RESYNC = object()
+
+
 @implementer(ISubscription)
 class _SimpleSubscription(object):
-    def __init__(self, subscriber, context, subscription_set, interest_tracker):
+    """Delivers notifications to a subscriber via the context's reactor.
+    
+    Notifications which have not yet been delivered are kept in a queue which is merged as new notifications arrive, so that a slow subscriber is called at most once per reactor turn and the queue does not grow without bound:
+    * A new value replaces everything pending.
+    * Consecutive patches are concatenated using patch_merger, if given; it may return None if they cannot be merged.
+    * If more than max_pending_length items of patches are pending, they are discarded and the subscriber is instead given the value from resync_getter.
+    Subscribers which are not IDeltaSubscribers are given each (merged) patch as a value.
+    """
+    def __init__(self, subscriber, context, subscription_set, interest_tracker,
+            resync_getter=None,
+            max_pending_length=None,
+            patch_merger=None):
         self.__subscriber = subscriber
         self.__reactor = context.reactor
         self.__subscription_set = subscription_set
         self.__interest_token = object()
         self.__interest_tracker = interest_tracker
+        self.__resync_getter = resync_getter
+        self.__max_pending_length = max_pending_length
+        self.__patch_merger = patch_merger
+        self.__pending = []  # list of [kind, argument]
+        self.__pending_length = 0
+        self.__delivery_call = None
         self.__interest_tracker.set(self.__interest_token, True)
         subscription_set.add(self)
     
     def _fire(self, value):
         # TODO: This is calling with a maybe-stale-when-it-arrives value. Do we want to tighten up and prohibit that in the specification of subscribe2?
-        self.__reactor.callLater(0, self.__subscriber, value)
+        self.__pending[:] = [[u'value', value]]
+        self.__pending_length = 0
+        self.__schedule()
     
     def _fire_append(self, patch):
-        if IDeltaSubscriber.providedBy(self.__subscriber):
-            self.__reactor.callLater(0, self.__subscriber.append, patch)
+        pending = self.__pending
+        if pending and pending[-1][1] is _RESYNC:
+            # The resync value will include this patch.
+            return
+        self.__pending_length += len(patch)
+        limit = self.__max_pending_length
+        if limit is not None and self.__resync_getter is not None and self.__pending_length > limit:
+            pending[:] = [[u'value', _RESYNC]]
+            self.__pending_length = 0
         else:
-            # TODO: Using patch as value is not specified to work in general. Arrange to consistently use IDeltaBuffer
-            self.__reactor.callLater(0, self.__subscriber, patch)
+            merged = None
+            if pending and pending[-1][0] == u'append' and self.__patch_merger is not None:
+                merged = self.__patch_merger(pending[-1][1], patch)
+            if merged is not None:
+                pending[-1][1] = merged
+            else:
+                pending.append([u'append', patch])
+        self.__schedule()
+    
+    def _wants_delta(self):
+        return IDeltaSubscriber.providedBy(self.__subscriber)
+    
+    def _wants_shape_delta(self):
+        return IShapeDeltaSubscriber.providedBy(self.__subscriber)
+    
+    def _fire_shape_delta(self, added, removed):
+        self.__pending.append([u'shape_delta', (added, removed)])
+        self.__schedule()
+    
+    def __schedule(self):
+        if self.__delivery_call is None:
+            self.__delivery_call = self.__reactor.callLater(0, self.__deliver)
+    
+    def __deliver(self):
+        self.__delivery_call = None
+        pending = self.__pending
+        self.__pending = []
+        self.__pending_length = 0
+        subscriber = self.__subscriber
+        for kind, argument in pending:
+            if kind == u'value':
+                if argument is _RESYNC:
+                    argument = self.__resync_getter()
+                subscriber(argument)
+            elif kind == u'append':
+                if IDeltaSubscriber.providedBy(subscriber):
+                    subscriber.append(argument)
+                else:
+                    # TODO: Using patch as value is not specified to work in general. Arrange to consistently use IDeltaBuffer
+                    subscriber(argument)
+            else:
+                subscriber.shape_delta(*argument)
     
     def unsubscribe(self):
         self.__subscription_set.remove(self)
         self.__interest_tracker.set(self.__interest_token, False)
+        if self.__delivery_call is not None:
+            self.__delivery_call.cancel()
+            self.__delivery_call = None
+            self.__pending = []
     
     def __repr__(self):
         return u'<{} calling {}>'.format(type(self).__name__, self.__subscriber)
@@ -674,6 +1110,7 @@ never_subscription = _NeverSubscription()
 
 class ExportedState(object):
     __cache = None
+    __cache_shared = False
     __setter_cells = None
     __shape_subscriptions = None
     
@@ -682,7 +1119,7 @@ class ExportedState(object):
         
         These cells are in addition to to those defined by decorators, not replacing them.
         
-        If state_is_dynamic(), then this method will be called multiple times (self.state_shape_changed() must be called to signal a change in the return value); otherwise, it will be called at most once and the result memoized.
+        The result is memoized. If state_is_dynamic(), then this method will be called again after self.state_shape_changed() is called to signal a change in the return value; otherwise, it will be called at most once.
         """
         return iter([])
     
@@ -697,10 +1134,14 @@ class ExportedState(object):
         return False
     
     def state(self):
+        """Return a dict of all of the cells of this object.
+        
+        The returned dict must not be mutated. It will not be mutated by this object either; a change in shape produces a new dict.
+        """
         # TODO: Catch and log exceptions, so that if something about state fetching blows up we can still present a consistent view. Or, possibly this should be done at the network layer instead.
         
         # pylint: disable=attribute-defined-outside-init
-        if self.state_is_dynamic() or self.__cache is None:
+        if self.__cache is None:
             cells = dict(self.__decorator_cells())
             
             def insert(key, cell):
@@ -712,7 +1153,38 @@ class ExportedState(object):
                 insert(key, cell)
             
             self.__cache = cells
-            
+        
+        self.__cache_shared = True
+        return self.__cache
+    
+    def _state_cell_inserted(self, key, cell):
+        """For implementations of dynamic objects: the cell for key has been added or replaced.
+        
+        This updates state() incrementally rather than by calling state_def() again. It does not notify shape subscribers; state_shape_changed() must still be called, with or without the details of the change.
+        """
+        cells = self.__writable_cache()
+        if cells is None:
+            return
+        if key in self.__decorator_cells():
+            raise KeyError('Cannot redefine {!r} from {!r} to {!r}'.format(key, cell, cells[key]))
+        cells[key] = cell
+    
+    def _state_cell_removed(self, key):
+        """For implementations of dynamic objects: the cell for key has been removed.
+        
+        See _state_cell_inserted.
+        """
+        cells = self.__writable_cache()
+        if cells is None:
+            return
+        cells.pop(key, None)
+    
+    def __writable_cache(self):
+        # pylint: disable=attribute-defined-outside-init
+        # Copy-on-write so that dicts previously returned from state() are never mutated.
+        if self.__cache is not None and self.__cache_shared:
+            self.__cache = dict(self.__cache)
+            self.__cache_shared = False
         return self.__cache
     
     def __decorator_cells(self):
@@ -722,27 +1194,15 @@ class ExportedState(object):
             return self.__decorator_cells_cache
         self.__decorator_cells_cache = {}
         self.__setter_cells = {}
-        class_obj = type(self)
-        for k in dir(class_obj):
-            if not hasattr(self, k): continue
-            v = getattr(class_obj, k)
-            # TODO use an interface here and move the check inside
-            if isinstance(v, ExportedGetter):
-                if not k.startswith('get_'):
-                    # TODO factor out attribute name usage in PollingCell so this restriction is moot for non-settable cells
-                    raise LookupError('Bad getter name', k)
-                else:
-                    k = k[len('get_'):]
-                setter_descriptor = getattr(class_obj, 'set_' + k, None)
-                if not isinstance(setter_descriptor, ExportedSetter):
-                    # e.g. a non-exported setter method
-                    setter_descriptor = None
-                cell = v.make_cell(self, k, writable=setter_descriptor is not None)
+        for attr, k, descriptor, setter_descriptor in _get_decorator_schema(type(self)):
+            if not hasattr(self, attr): continue
+            if isinstance(descriptor, ExportedGetter):
+                cell = descriptor.make_cell(self, k, writable=setter_descriptor is not None)
                 if setter_descriptor is not None:
                     self.__setter_cells[setter_descriptor] = cell
                 self.__decorator_cells_cache[k] = cell
-            elif isinstance(v, ExportedCommand):
-                self.__decorator_cells_cache[k] = v.make_cell(self, k)
+            else:
+                self.__decorator_cells_cache[k] = descriptor.make_cell(self, k)
         return self.__decorator_cells_cache
     
     def state_subscribe(self, subscriber, context):
@@ -760,7 +1220,7 @@ class ExportedState(object):
         if table is None:
             # state() has not yet been called, so the cell has not been created, so there are no possible subscriptions to notify, so we don't need to do anything.
             return
-        table[setter_descriptor].poll_for_change_from_setter()
+        after_state_batch(table[setter_descriptor].poll_for_change_from_setter)
     
     def state_changed(self, key=None):
         """To be called by the object's implementation when a cell value has been changed.
@@ -770,21 +1230,35 @@ class ExportedState(object):
         state = self.state()
         if key is None:
             for cell in six.itervalues(state):
-                cell.poll_for_change(specific_cell=False)
+                after_state_batch(cell.poll_for_change, False)
         else:
-            state[key].poll_for_change(specific_cell=True)
+            after_state_batch(state[key].poll_for_change, True)
     
-    def state_shape_changed(self):
+    def state_shape_changed(self, added=None, removed=None):
         """To be called by the object's implementation when it has gained, lost, or replaced a cell.
         
         This only applies to objects which return True from state_is_dynamic().
+        
+        If the caller knows exactly what changed, it may pass added (a dict of key to cell) and removed (a set of keys) so that subscribers providing IShapeDeltaSubscriber are given only those changes. In that case, the caller must already have reported the changes via _state_cell_inserted and _state_cell_removed; otherwise, state_def() will be consulted again.
         """
-        new_state = self.state()
+        # pylint: disable=attribute-defined-outside-init
+        if added is None:
+            self.__cache = None
         subscriptions = self.__shape_subscriptions
-        if subscriptions is None:
+        if not subscriptions:
             return
+        new_state = None
         for subscription in subscriptions:
-            subscription._fire(new_state)
+            if added is not None and subscription._wants_shape_delta():
+                subscription._fire_shape_delta(added, removed)
+            else:
+                if new_state is None:
+                    new_state = self.state()
+                subscription._fire(new_state)
+    
+    def _has_shape_subscriptions(self):
+        """Whether anything would be notified by state_shape_changed."""
+        return bool(self.__shape_subscriptions)
     
     def state_to_json(self, subscriber=lambda _: None):
         subscriber(self.state_subscribe)
@@ -795,42 +1269,58 @@ class ExportedState(object):
         return state
     
     def state_from_json(self, state, log=_log):
+        """Set the values of this object's cells, and the states of the objects referenced by its cells, from a JSON value as returned by state_to_json.
+        
+        All values are checked and coerced to their cells' types before any are set, and the setting is done within a state_batch() so that change notifications and other work registered with after_state_batch happen once at the end. Values which cannot be used are logged and discarded.
+        """
         cells = self.state()
         dynamic = self.state_is_dynamic()
+        actions = []  # (function, key, argument)
         defer = []
-        for key in state:
-            # pylint: disable=cell-var-from-loop, undefined-loop-variable
-            def err(adjective, failure=None):
-                # TODO ship to client
-                log.warn('Discarding {problem} state {target}.{key} = {value}',
-                    problem=adjective,
-                    target=self,
-                    key=key,
-                    value=state[key],
-                    **({'log_failure': failure} if failure else {}))
-            
-            def doTry(f):
-                try:
-                    f()
-                except (LookupError, TypeError, ValueError):
-                    # a plausible set of exceptions, so we don't catch implausible ones
-                    err('erroneous', Failure())
-            
+        for key, value in six.iteritems(state):
             cell = cells.get(key, None)
             if cell is None:
                 if dynamic:
-                    doTry(lambda: self.state_insert(key, state[key]))
+                    actions.append((self.state_insert, key, value))
                 else:
-                    err('nonexistent')
+                    self.__state_from_json_error(log, 'nonexistent', key, value)
             elif cell.type().is_reference():
                 defer.append(key)
             elif not cell.isWritable():
-                err('non-writable')
+                self.__state_from_json_error(log, 'non-writable', key, value)
             else:
-                doTry(lambda: cells[key].set_state(state[key]))
-        # blocks are deferred because the specific blocks may depend on other keys
-        for key in defer:
-            cells[key].set_state(state[key])
+                try:
+                    coerced = cell.type()(value)
+                except (LookupError, TypeError, ValueError):
+                    self.__state_from_json_error(log, 'erroneous', key, value, Failure())
+                else:
+                    actions.append((lambda key, value: cells[key].set_state(value), key, coerced))
+        
+        def deferred_error_handler(key):
+            # Failures of the batched side effects of setting a value are reported like failures of setting it, rather than aborting the whole restore.
+            return lambda: self.__state_from_json_error(log, 'erroneous', key, state[key], Failure())
+        
+        with state_batch():
+            for function, key, value in actions:
+                with state_batch(on_error=deferred_error_handler(key)):
+                    try:
+                        function(key, value)
+                    except (LookupError, TypeError, ValueError):
+                        # a plausible set of exceptions, so we don't catch implausible ones
+                        self.__state_from_json_error(log, 'erroneous', key, state[key], Failure())
+            # blocks are deferred because the specific blocks may depend on other keys
+            for key in defer:
+                with state_batch(on_error=deferred_error_handler(key)):
+                    cells[key].set_state(state[key])
+    
+    def __state_from_json_error(self, log, adjective, key, value, failure=None):
+        # TODO ship to client
+        log.warn('Discarding {problem} state {target}.{key} = {value}',
+            problem=adjective,
+            target=self,
+            key=key,
+            value=value,
+            **({'log_failure': failure} if failure else {}))
 
 
 def unserialize_exported_state(ctor, kwargs=None, state=None):
@@ -875,7 +1365,7 @@ class CellDict(object):
         # pylint: disable=dangerous-default-value
         self.__member_type = member_type
         self.__cells = {}
-        self._shape_subscription = lambda: None
+        self._shape_subscription = lambda added, removed: None
         
         self._dynamic = True
         for key in initial_state:
@@ -896,18 +1386,35 @@ class CellDict(object):
             self.__cells[key].set_internal(value)
         else:
             assert self._dynamic
-            self.__cells[key] = LooseCell(
-                value=value,
-                type=self.__member_type,
-                persists=True,
-                writable=False)
-            self._shape_subscription()
+            self.__cells[key] = self.__make_cell(value)
+            self._shape_subscription(added=(key,), removed=())
+    
+    def update(self, other):
+        """Set each key-value pair from the dict other, as if by self[key] = value, but with only one shape change notification."""
+        cells = self.__cells
+        added = []
+        for key, value in six.iteritems(other):
+            if key in cells:
+                cells[key].set_internal(value)
+            else:
+                assert self._dynamic
+                cells[key] = self.__make_cell(value)
+                added.append(key)
+        if added:
+            self._shape_subscription(added=added, removed=())
+    
+    def __make_cell(self, value):
+        return LooseCell(
+            value=value,
+            type=self.__member_type,
+            persists=True,
+            writable=False)
     
     def __delitem__(self, key):
         assert self._dynamic
         if key in self.__cells:
             del self.__cells[key]
-            self._shape_subscription()
+            self._shape_subscription(added=(), removed=(key,))
     
     def __iter__(self):
         return self.iterkeys()
@@ -942,13 +1449,59 @@ class CellDict(object):
 class CollectionState(ExportedState):
     """Wrapper around a CellDict which exports its contents.
     
-    Suitable for use as a superclass or mixin as well as by itself."""
+    Suitable for use as a superclass or mixin as well as by itself.
     
-    def __init__(self, cell_dict):
+    Changes to the contents of the CellDict are coalesced, so that shape subscribers are notified at most once per shape_change_interval seconds (by default, once per reactor turn) however many keys were added or removed. This is scheduled with the reactor of the subscribers' SubscriptionContext.
+    """
+    
+    def __init__(self, cell_dict, shape_change_interval=0):
         self.__collection = cell_dict
         self.__dynamic = cell_dict._dynamic
+        self.__reactor = None  # from the most recent subscription's context
+        self.__shape_change_interval = shape_change_interval
+        self.__shape_change_call = None
+        self.__pending_added = set()
+        self.__pending_removed = set()
+        
+        cell_dict._shape_subscription = self.__collection_shape_changed
+    
+    def state_subscribe(self, subscriber, context):
+        self.__reactor = context.reactor
+        return super(CollectionState, self).state_subscribe(subscriber, context)
+    
+    def __collection_shape_changed(self, added, removed):
+        collection = self.__collection
+        for key in removed:
+            self._state_cell_removed(key)
+        for key in added:
+            self._state_cell_inserted(key, collection.get_cell(key))
         
-        cell_dict._shape_subscription = self.state_shape_changed
+        if not self._has_shape_subscriptions():
+            # No one to notify, and new subscribers will get the current state().
+            return
+        pending_added = self.__pending_added
+        pending_removed = self.__pending_removed
+        for key in removed:
+            if key in pending_added:
+                # added and removed within one interval; net no change unless it replaced an existing key
+                pending_added.remove(key)
+            else:
+                pending_removed.add(key)
+        for key in added:
+            pending_added.add(key)
+        if self.__shape_change_call is None:
+            self.__shape_change_call = self.__reactor.callLater(
+                self.__shape_change_interval,
+                self.__flush_shape_change)
+    
+    def __flush_shape_change(self):
+        self.__shape_change_call = None
+        collection = self.__collection
+        added = {key: collection.get_cell(key) for key in self.__pending_added}
+        removed = self.__pending_removed
+        self.__pending_added = set()
+        self.__pending_removed = set()
+        self.state_shape_changed(added=added, removed=removed)
     
     def state_is_dynamic(self):
         return self.__dynamic
@@ -966,6 +1519,102 @@ class IWritableCollection(Interface):
     """
 
 
+class _StateBatch(threading.local):
+    # Per-thread so that work done by other threads (such as GNU Radio callbacks) is neither deferred into nor flushed by a batch it is not part of.
+    def __init__(self):
+        super(_StateBatch, self).__init__()
+        self.depth = 0
+        self.pending = OrderedDict()  # (function, args) -> error handler or None
+        self.error_handlers = []  # stack of the on_error of enclosing batches
+
+
+_state_batch = _StateBatch()
+
+
+@contextmanager
+def state_batch(on_error=None):
+    """Context manager which postpones the work registered with after_state_batch, including checking cells for changes after their setters are called, until the outermost batch ends.
+    
+    Intended for making many changes at once, such as when restoring state.
+    
+    If the postponed work fails, the rest is still done, and then the first exception is raised from the end of the outermost batch. However, if on_error is given, then failures of work first registered within this batch (and not within a nested batch with its own on_error) are instead handled by calling on_error() from within the except clause.
+    """
+    batch = _state_batch
+    batch.depth += 1
+    if on_error is not None:
+        batch.error_handlers.append(on_error)
+    try:
+        yield
+    finally:
+        if on_error is not None:
+            batch.error_handlers.pop()
+        batch.depth -= 1
+        if batch.depth == 0:
+            _flush_state_batch()
+
+
+def after_state_batch(function, *args):
+    """Call function(*args) when the current state_batch ends, or immediately if there is none.
+    
+    Within a batch, repeated requests with an equal function (such as the same method of the same object) and arguments result in only one call. Objects may use this to avoid redoing expensive reconfiguration for each of several related changes.
+    """
+    if _state_batch.depth:
+        handlers = _state_batch.error_handlers
+        _state_batch.pending.setdefault((function, args), handlers[-1] if handlers else None)
+    else:
+        function(*args)
+
+
+def _flush_state_batch():
+    """Do the pending work of the batch which just ended. If any of it fails without an error handler, the rest is still done and then the first such exception is raised, as it would have been outside of a batch."""
+    pending = _state_batch.pending
+    first_failure = None
+    while pending:
+        (function, args), on_error = pending.popitem(last=False)
+        try:
+            function(*args)
+        except Exception:  # pylint: disable=broad-except
+            if on_error is not None:
+                on_error()
+            elif first_failure is None:
+                first_failure = sys.exc_info()
+            else:
+                _log.failure('Error in deferred state batch work {function}', function=function)
+    if first_failure is not None:
+        six.reraise(*first_failure)
+
+
+def _get_decorator_schema(class_obj):
+    """Return a list of (attribute name, key, ExportedGetter or ExportedCommand, ExportedSetter or None) for the decorated members of class_obj.
+    
+    This is cached per class so that each new ExportedState instance does not need to search its class.
+    """
+    schema = _decorator_schema_cache.get(class_obj)
+    if schema is not None:
+        return schema
+    schema = []
+    for attr in dir(class_obj):
+        v = getattr(class_obj, attr, None)  # some attributes, such as zope.interface's __provides__, exist only on instances
+        # TODO use an interface here and move the check inside
+        if isinstance(v, ExportedGetter):
+            if not attr.startswith('get_'):
+                # TODO factor out attribute name usage in PollingCell so this restriction is moot for non-settable cells
+                raise LookupError('Bad getter name', attr)
+            k = attr[len('get_'):]
+            setter_descriptor = getattr(class_obj, 'set_' + k, None)
+            if not isinstance(setter_descriptor, ExportedSetter):
+                # e.g. a non-exported setter method
+                setter_descriptor = None
+            schema.append((attr, k, v, setter_descriptor))
+        elif isinstance(v, ExportedCommand):
+            schema.append((attr, attr, v, None))
+    _decorator_schema_cache[class_obj] = schema
+    return schema
+
+
+_decorator_schema_cache = weakref.WeakKeyDictionary()
+
+
 def exported_value(parameter=None, **cell_kwargs):
     """Returns a decorator for exported state; takes PollingCell's kwargs."""
     def decorator(f):